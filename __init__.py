@@ -1 +1 @@
-__all__ = ['fileutil', 'runutil', 'tempcache']
+__all__ = ['benchmark', 'fileutil', 'metrics', 'runutil', 'tempcache']
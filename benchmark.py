@@ -0,0 +1,758 @@
+"""
+Benchmarks for eeepy I/O hot paths.
+
+The suite generates synthetic directory trees and files in a work directory on local disk or tmpfs, times searching,
+copying, checksumming, and `TempCache` writeback, and writes the results as JSON. Results can be compared with a
+stored baseline to find regressions. It needs no network access or packages outside the standard library.
+
+Run as a module:
+
+    python -m eeepy.benchmark --output results.json
+    python -m eeepy.benchmark --baseline results.json
+"""
+
+import argparse
+import collections
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from eeepy import fileutil
+from eeepy import tempcache
+
+
+# Checksum algorithms measured by default
+CHECKSUM_ALGORITHMS = ('md5', 'sha1', 'sha256', 'blake2b', 'blake2s', 'crc32', 'adler32')
+
+# Benchmark groups run by `run_suite()`
+BENCHMARK_GROUPS = ('search_dir', 'copyfileobj', 'checksum', 'writeback')
+
+# Directory tree shapes at scale 1 (see `make_tree()`): (levels, subdirectories per directory, files per directory,
+# symbolic links)
+TREE_SHAPES = {
+    'wide': (1, 200, 20, False),
+    'deep': (40, 1, 50, False),
+    'small_files': (2, 30, 12, False),
+    'symlinks': (2, 10, 20, True),
+}
+
+# Size of files at scale 1
+_LARGE_FILE_SIZE = 128 * 1024 ** 2
+_SMALL_FILE_SIZE = 4 * 1024
+
+# Number and size of files written back by the writeback benchmark at scale 1
+_WRITEBACK_FILES = 8
+_WRITEBACK_FILE_SIZE = 16 * 1024 ** 2
+
+# Rate limit of the bandwidth-limited copy benchmark in bytes per second. The benchmark copies a quarter of the large
+# file, which takes about 0.25 seconds at the limit, with a burst of 64 KiB.
+_BENCH_BANDWIDTH = 128 * 1024 ** 2
+
+# Results with a time this much larger than the baseline are regressions
+DEFAULT_TOLERANCE = 0.1
+
+# Results faster than this number of seconds, in the baseline or the new run, are too noisy to compare
+DEFAULT_MIN_SECONDS = 0.001
+
+
+def make_file(file_name, size, block_length=1024*1024):
+    """
+    Write a file of random bytes.
+
+    :param file_name: Name of the file to write.
+    :param size: Size of the file in bytes.
+    :param block_length: Write random data in blocks of this length.
+
+    :return: `file_name`.
+    """
+
+    with open(file_name, 'wb') as out_file:
+        block = os.urandom(block_length)
+
+        for offset in range(0, size, block_length):
+            out_file.write(block[:min(block_length, size - offset)])
+
+    return file_name
+
+
+def make_tree(root_dir, levels, n_dirs, n_files, file_size=_SMALL_FILE_SIZE, symlinks=False):
+    """
+    Create a synthetic directory tree. Every directory holds `n_files` files and, above the last level, `n_dirs`
+    subdirectories. Files are named "file<n>.dat" or "file<n>.txt", alternately, so searches can match half of them.
+    If `symlinks` is set, each "file<n>.dat" is a symbolic link to the file before it, and searches must resolve it.
+
+    :param root_dir: Root directory of the tree. Created if it does not exist.
+    :param levels: Number of directory levels below `root_dir`.
+    :param n_dirs: Number of subdirectories in each directory.
+    :param n_files: Number of files in each directory.
+    :param file_size: Size of each file in bytes.
+    :param symlinks: Create files with odd numbers as symbolic links.
+
+    :return: Number of files and links created.
+    """
+
+    data = os.urandom(file_size)
+
+    n_created = 0
+    dir_list = [root_dir]
+
+    for level in range(levels + 1):
+        next_dir_list = list()
+
+        for dir_name in dir_list:
+            os.makedirs(dir_name, exist_ok=True)
+
+            for index in range(n_files):
+                file_name = os.path.join(dir_name, 'file{}.{}'.format(index, 'dat' if index % 2 else 'txt'))
+
+                if symlinks and index % 2:
+                    os.symlink('file{}.txt'.format(index - 1), file_name)
+
+                else:
+                    with open(file_name, 'wb') as out_file:
+                        out_file.write(data)
+
+                n_created += 1
+
+            if level < levels:
+                next_dir_list.extend(os.path.join(dir_name, 'dir{}'.format(index)) for index in range(n_dirs))
+
+        dir_list = next_dir_list
+
+    return n_created
+
+
+def _best_times(func, repeat):
+    """
+    Time a function and measure the CPU time it uses.
+
+    :param func: Function called with no arguments.
+    :param repeat: Number of times to call `func`.
+
+    :return: A tuple of the shortest run time and the smallest CPU time of this process (`time.process_time()`, all
+        threads) in seconds.
+    """
+
+    best_time = None
+    best_cpu_time = None
+
+    for count in range(repeat):
+        start_time = time.perf_counter()
+        start_cpu_time = time.process_time()
+        func()
+        cpu_time = time.process_time() - start_cpu_time
+        run_time = time.perf_counter() - start_time
+
+        if best_time is None or run_time < best_time:
+            best_time = run_time
+
+        if best_cpu_time is None or cpu_time < best_cpu_time:
+            best_cpu_time = cpu_time
+
+    return best_time, best_cpu_time
+
+
+def _best_time(func, repeat):
+    """
+    Time a function.
+
+    :param func: Function called with no arguments.
+    :param repeat: Number of times to call `func`.
+
+    :return: Shortest run time in seconds.
+    """
+
+    return _best_times(func, repeat)[0]
+
+
+def _result(seconds, amount=None, unit=None):
+    """
+    Create a benchmark result.
+
+    :param seconds: Run time in seconds.
+    :param amount: Amount of work done in `seconds`, such as bytes or files, or `None`.
+    :param unit: Unit of the throughput, such as "MB/s", if `amount` is set. "MB/s" divides `amount` by 10^6.
+
+    :return: A dictionary with "seconds", and "throughput" and "unit" if `amount` is set.
+    """
+
+    result = {'seconds': seconds}
+
+    if amount is not None:
+        if unit == 'MB/s':
+            amount /= 1e6
+
+        result['throughput'] = amount / seconds if seconds > 0 else float('inf')
+        result['unit'] = unit
+
+    return result
+
+
+class _LimitedReader:
+    """
+    Read at most a number of bytes from a file object.
+    """
+
+    def __init__(self, file_obj, size):
+        self.file_obj = file_obj
+        self.remaining = size
+
+    def read(self, length=-1):
+        if length < 0 or length > self.remaining:
+            length = self.remaining
+
+        buf = self.file_obj.read(length)
+        self.remaining -= len(buf)
+
+        return buf
+
+    def readinto(self, b):
+        with memoryview(b) as view:
+            n_bytes = self.file_obj.readinto(view[:self.remaining])
+
+        self.remaining -= n_bytes
+
+        return n_bytes
+
+
+class _CountedDirEntry:
+    """
+    A `os.DirEntry` that counts the `stat` system calls it makes with a `_StatCounter`.
+
+    An entry calls `stat` when `stat()` is first called, and when `is_file()` or `is_dir()` first follows a symbolic
+    link. The result is cached by the entry, and a link is resolved once for `stat()` and type checks together. Other
+    type checks use the file type returned by `os.scandir()`.
+    """
+
+    def __init__(self, entry, counter):
+        self.__entry = entry
+        self.__counter = counter
+
+        # Stat results cached by the entry: True for the target of a symbolic link and False for the entry itself
+        self.__cached = set()
+
+    def __count_stat(self, follow_symlinks):
+        resolve = bool(follow_symlinks) and self.__entry.is_symlink()
+
+        if resolve not in self.__cached:
+            self.__cached.add(resolve)
+            self.__counter.add('DirEntry.stat')
+
+    def stat(self, *, follow_symlinks=True):
+        self.__count_stat(follow_symlinks)
+
+        return self.__entry.stat(follow_symlinks=follow_symlinks)
+
+    def is_file(self, *, follow_symlinks=True):
+        if follow_symlinks and self.__entry.is_symlink():
+            self.__count_stat(True)
+
+        return self.__entry.is_file(follow_symlinks=follow_symlinks)
+
+    def is_dir(self, *, follow_symlinks=True):
+        if follow_symlinks and self.__entry.is_symlink():
+            self.__count_stat(True)
+
+        return self.__entry.is_dir(follow_symlinks=follow_symlinks)
+
+    def __fspath__(self):
+        return self.__entry.path
+
+    def __getattr__(self, name):
+        return getattr(self.__entry, name)
+
+
+class _CountedScandir:
+    """
+    Iterator returned by `os.scandir()` while a `_StatCounter` is active. Counts entries and wraps them in
+    `_CountedDirEntry` objects.
+    """
+
+    def __init__(self, entry_iter, counter):
+        self.__entry_iter = entry_iter
+        self.__counter = counter
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        entry = next(self.__entry_iter)
+        self.__counter.add('entries')
+
+        return _CountedDirEntry(entry, self.__counter)
+
+    def close(self):
+        self.__entry_iter.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, ex_type, ex_value, ex_tb):
+        self.close()
+
+        return False
+
+
+class _StatCounter:
+    """
+    Count calls of `os.stat()`, `os.lstat()`, and `os.scandir()`, `stat` calls made by the entries `os.scandir()`
+    returns (counted as "DirEntry.stat", see `_CountedDirEntry`), and the entries, while used as a context manager.
+    Functions that call these, such as `os.path.isdir()`, are counted too.
+
+    Entries are assumed to have a file type, as they do on most local and network file systems. On a file system that
+    does not return one, type checks call `stat` for every entry, and these calls are not counted.
+    """
+
+    # Functions in `os` that are replaced while counting
+    FUNCTIONS = ('stat', 'lstat', 'scandir')
+
+    def __init__(self):
+        self.counts = collections.Counter()
+
+        self.__lock = threading.Lock()
+        self.__saved = dict()
+
+    def add(self, name):
+        with self.__lock:
+            self.counts[name] += 1
+
+    def syscalls(self):
+        """
+        Get the number of counted calls.
+
+        :return: Number of calls of all counted functions.
+        """
+
+        return sum(count for name, count in self.counts.items() if name != 'entries')
+
+    def __wrap(self, name, func):
+
+        def counted(*args, **kwargs):
+            self.add(name)
+
+            if name == 'scandir':
+                return _CountedScandir(func(*args, **kwargs), self)
+
+            return func(*args, **kwargs)
+
+        return counted
+
+    def __enter__(self):
+        for name in _StatCounter.FUNCTIONS:
+            self.__saved[name] = getattr(os, name)
+            setattr(os, name, self.__wrap(name, self.__saved[name]))
+
+        return self
+
+    def __exit__(self, ex_type, ex_value, ex_tb):
+        for name, func in self.__saved.items():
+            setattr(os, name, func)
+
+        self.__saved.clear()
+
+        return False
+
+
+def _get_large_file(work_dir, scale):
+    """
+    Get the large file shared by benchmarks, and create it if it does not exist.
+
+    :param work_dir: Directory of the file.
+    :param scale: Multiply the file size by this factor.
+
+    :return: File name.
+    """
+
+    file_name = os.path.join(work_dir, 'large.dat')
+
+    if not os.path.isfile(file_name):
+        make_file(file_name, max(1024 * 1024, int(_LARGE_FILE_SIZE * scale)))
+
+    return file_name
+
+
+def bench_search_dir(work_dir, scale=1.0, repeat=3):
+    """
+    Time `fileutil.search_dir()` on synthetic trees (see `TREE_SHAPES`). Each tree is searched for all files and for
+    files matching a pattern.
+
+    Each search is also run once while counting `stat` and `scandir` calls (see `_StatCounter`), and its result has
+    "syscalls" and "syscalls_per_entry", the number of calls divided by the number of directory entries read.
+
+    :param work_dir: Directory the trees are created in.
+    :param scale: Multiply the number of files in each directory by this factor. At least 2 files are created in each
+        directory, so the pattern, which matches every other file, always finds files.
+    :param repeat: Time each search this many times and report the fastest run.
+
+    :return: A dictionary of results keyed by benchmark name.
+    """
+
+    results = dict()
+
+    for shape, (levels, n_dirs, n_files, symlinks) in sorted(TREE_SHAPES.items()):
+        root_dir = os.path.join(work_dir, 'tree_' + shape)
+
+        if not os.path.isdir(root_dir):
+            make_tree(root_dir, levels, n_dirs, max(2, int(n_files * scale)), symlinks=symlinks)
+
+        for name, pattern in (('', '.*'), ('.pattern', r'.*\.dat$')):
+
+            with _StatCounter() as counter:
+                n_found = len(fileutil.search_dir(root_dir, pattern=pattern))
+
+            result = _result(
+                _best_time(lambda: fileutil.search_dir(root_dir, pattern=pattern), repeat), n_found, 'files/s'
+            )
+
+            result['syscalls'] = counter.syscalls()
+            result['syscalls_per_entry'] = counter.syscalls() / max(counter.counts['entries'], 1)
+
+            results['search_dir.' + shape + name] = result
+
+    return results
+
+
+def bench_copyfileobj(work_dir, scale=1.0, repeat=3):
+    """
+    Time `fileutil.copyfileobj()` copying a large file with the plain and the adaptive copy loop, each with and without
+    a bandwidth limit. The source is read once before timing, so it is read from the page cache if it fits in memory.
+
+    :param work_dir: Directory the files are created in.
+    :param scale: Multiply the file size by this factor.
+    :param repeat: Time each copy this many times and report the fastest run.
+
+    :return: A dictionary of results keyed by benchmark name. Bandwidth-limited results show how closely the copy
+        rate follows the limit. Each result also has "cpu_seconds", the CPU time of the copy, and "cpu_per_gb", CPU
+        seconds per 10^9 bytes copied, which shows the overhead of the copy loop and of waiting for the limit.
+    """
+
+    src_file = _get_large_file(work_dir, scale)
+    dst_file = os.path.join(work_dir, 'copy.dat')
+
+    size = os.path.getsize(src_file)
+    limited_size = size // 4
+
+    def copy(limited=False, adaptive=False):
+        with open(src_file, 'rb') as fsrc:
+            with open(dst_file, 'wb') as fdst:
+                if limited:
+                    governor = fileutil.BandwidthGovernor(str(_BENCH_BANDWIDTH) + 'b', 64 * 1024)
+                    fileutil.copyfileobj(
+                        _LimitedReader(fsrc, limited_size), fdst, bandwidth=governor, adaptive=adaptive
+                    )
+                else:
+                    fileutil.copyfileobj(fsrc, fdst, adaptive=adaptive)
+
+    try:
+        tempcache._get_checksum(src_file, 'crc32')
+
+        results = dict()
+
+        for name, limited, adaptive in (
+                ('copyfileobj.unlimited', False, False),
+                ('copyfileobj.adaptive', False, True),
+                ('copyfileobj.bandwidth', True, False),
+                ('copyfileobj.adaptive_bandwidth', True, True)):
+
+            copy_size = limited_size if limited else size
+            best_time, cpu_time = _best_times(lambda: copy(limited, adaptive), repeat)
+
+            result = _result(best_time, copy_size, 'MB/s')
+            result['cpu_seconds'] = cpu_time
+            result['cpu_per_gb'] = cpu_time / (copy_size / 1e9)
+
+            if limited:
+                result['limit'] = _BENCH_BANDWIDTH / 1e6
+
+            results[name] = result
+
+        return results
+
+    finally:
+        if os.path.exists(dst_file):
+            os.remove(dst_file)
+
+
+def checksum_throughput(file_name=None, size=256*1024**2, algorithms=CHECKSUM_ALGORITHMS, repeat=3, temp_dir=None):
+    """
+    Measure the throughput of checksum algorithms with `tempcache._get_checksum()`.
+
+    The file is read once before timing, so if it fits in memory, the results measure the checksum algorithm and not
+    the storage device.
+
+    :param file_name: File to checksum or `None` to write a file of random bytes in `temp_dir`.
+    :param size: Size of the generated file if `file_name` is `None`.
+    :param algorithms: Algorithm names (see `tempcache._new_hash()`).
+    :param repeat: Time each algorithm this many times and report the fastest run.
+    :param temp_dir: Directory for the generated file or `None` to use the system temporary directory.
+
+    :return: A dictionary of throughput in GB/s (10^9 bytes per second) keyed by algorithm name.
+    """
+
+    # Create file
+    remove_file = False
+
+    if file_name is None:
+        file_fd, file_name = tempfile.mkstemp(prefix='eeepy_bench_', dir=temp_dir)
+        os.close(file_fd)
+        remove_file = True
+
+        make_file(file_name, size)
+
+    try:
+        size = os.path.getsize(file_name)
+
+        # Read into the page cache
+        tempcache._get_checksum(file_name, 'crc32')
+
+        # Time
+        throughput = dict()
+
+        for algorithm in algorithms:
+            best_time = _best_time(lambda: tempcache._get_checksum(file_name, algorithm), repeat)
+
+            throughput[algorithm] = size / best_time / 1e9 if best_time > 0 else float('inf')
+
+        return throughput
+
+    finally:
+        if remove_file:
+            os.remove(file_name)
+
+
+def bench_checksum(work_dir, scale=1.0, repeat=3, algorithms=CHECKSUM_ALGORITHMS):
+    """
+    Time `tempcache._get_checksum()` on a large file (see `checksum_throughput()`).
+
+    :param work_dir: Directory the file is created in.
+    :param scale: Multiply the file size by this factor.
+    :param repeat: Time each algorithm this many times and report the fastest run.
+    :param algorithms: Algorithm names.
+
+    :return: A dictionary of results keyed by benchmark name.
+    """
+
+    file_name = _get_large_file(work_dir, scale)
+    size = os.path.getsize(file_name)
+
+    return {
+        'checksum.' + algorithm: _result(size / (gb_per_sec * 1e9) if gb_per_sec > 0 else 0.0, size, 'MB/s')
+        for algorithm, gb_per_sec in checksum_throughput(file_name, algorithms=algorithms, repeat=repeat).items()
+    }
+
+
+def bench_writeback(work_dir, scale=1.0, repeat=3):
+    """
+    Time `TempCache` writeback of a set of files with validation off ("none") and on ("full"). Files are written to
+    the temporary directory before timing, and only `do_copy()` is timed.
+
+    :param work_dir: Directory holding the temporary and destination directories.
+    :param scale: Multiply the file size by this factor.
+    :param repeat: Time each validation level this many times and report the fastest run.
+
+    :return: A dictionary of results keyed by benchmark name.
+    """
+
+    temp_dir = os.path.join(work_dir, 'writeback_temp')
+    dest_dir = os.path.join(work_dir, 'writeback_dest')
+
+    file_size = max(1, int(_WRITEBACK_FILE_SIZE * scale))
+    data = os.urandom(file_size)
+
+    results = dict()
+
+    for validate in ('none', 'full'):
+        best_time = None
+
+        for count in range(repeat):
+            for dir_name in (temp_dir, dest_dir):
+                shutil.rmtree(dir_name, ignore_errors=True)
+                os.makedirs(dir_name)
+
+            cache = tempcache.TempCache(temp_dir, retry=0, validate=validate)
+
+            for index in range(_WRITEBACK_FILES):
+                with open(cache.register(os.path.join(dest_dir, 'file{}.dat'.format(index))), 'wb') as out_file:
+                    out_file.write(data)
+
+            start_time = time.perf_counter()
+            cache.do_copy()
+            run_time = time.perf_counter() - start_time
+
+            if best_time is None or run_time < best_time:
+                best_time = run_time
+
+        results['writeback.validate_' + validate] = _result(best_time, file_size * _WRITEBACK_FILES, 'MB/s')
+
+    for dir_name in (temp_dir, dest_dir):
+        shutil.rmtree(dir_name, ignore_errors=True)
+
+    return results
+
+
+def run_suite(work_dir=None, scale=1.0, repeat=3, groups=BENCHMARK_GROUPS):
+    """
+    Run benchmarks.
+
+    :param work_dir: Directory for generated trees and files, or `None` to use a new directory in the system temporary
+        directory. A directory on local disk or tmpfs gives the most stable results. Generated files are removed when
+        the suite finishes.
+    :param scale: Multiply file counts and sizes by this factor. Values below 1 give a quick, less precise run.
+    :param repeat: Run each benchmark this many times and report the fastest run.
+    :param groups: Benchmark groups to run (see `BENCHMARK_GROUPS`).
+
+    :return: A dictionary with "meta", describing the host and parameters, and "results", a dictionary of results
+        keyed by benchmark name. Each result has "seconds", and "throughput" and "unit" if it measures a rate.
+    """
+
+    for group in groups:
+        if group not in BENCHMARK_GROUPS:
+            raise ValueError('Benchmark group must be one of {}: {}'.format(', '.join(BENCHMARK_GROUPS), group))
+
+    bench_func = {
+        'search_dir': bench_search_dir,
+        'copyfileobj': bench_copyfileobj,
+        'checksum': bench_checksum,
+        'writeback': bench_writeback,
+    }
+
+    bench_dir = tempfile.mkdtemp(prefix='eeepy_bench_', dir=work_dir)
+
+    try:
+        results = dict()
+
+        for group in groups:
+            results.update(bench_func[group](bench_dir, scale, repeat))
+
+    finally:
+        shutil.rmtree(bench_dir, ignore_errors=True)
+
+    return {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'work_dir': os.path.dirname(bench_dir),
+            'scale': scale,
+            'repeat': repeat,
+        },
+        'results': results,
+    }
+
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE, min_seconds=DEFAULT_MIN_SECONDS):
+    """
+    Compare benchmark results with a baseline.
+
+    :param results: Results returned by `run_suite()`.
+    :param baseline: Baseline results returned by `run_suite()` on the same host with the same scale.
+    :param tolerance: Times this fraction larger than the baseline are regressions, and times this fraction smaller
+        are improvements.
+    :param min_seconds: Benchmarks that took less than this number of seconds in the baseline or in `results` are
+        too short to time reliably, and their status is "noise".
+
+    :return: A list of `(name, baseline_seconds, seconds, ratio, status)` tuples for benchmarks in both results, where
+        `ratio` is `seconds / baseline_seconds` and `status` is "regression", "improvement", "ok", or "noise".
+    """
+
+    comparison = list()
+
+    for name, result in sorted(results['results'].items()):
+        base_result = baseline['results'].get(name)
+
+        if base_result is None or base_result['seconds'] <= 0:
+            continue
+
+        ratio = result['seconds'] / base_result['seconds']
+
+        if min(base_result['seconds'], result['seconds']) < min_seconds:
+            status = 'noise'
+        elif ratio > 1 + tolerance:
+            status = 'regression'
+        elif ratio < 1 - tolerance:
+            status = 'improvement'
+        else:
+            status = 'ok'
+
+        comparison.append((name, base_result['seconds'], result['seconds'], ratio, status))
+
+    return comparison
+
+
+def main(args=None):
+    """
+    Run the benchmark suite from the command line.
+
+    :param args: Command line arguments or `None` to use `sys.argv`.
+
+    :return: Exit code: 1 if a baseline was given and a benchmark regressed, and 0 otherwise.
+    """
+
+    parser = argparse.ArgumentParser(description='Benchmark eeepy I/O hot paths.')
+
+    parser.add_argument('--work-dir', help='Directory for generated files (default: system temporary directory)')
+    parser.add_argument('--scale', type=float, default=1.0, help='Scale file counts and sizes (default: 1)')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs of each benchmark; the fastest counts (default: 3)')
+    parser.add_argument(
+        '--group', action='append', choices=BENCHMARK_GROUPS, help='Run only this group (may be repeated)'
+    )
+    parser.add_argument('--output', help='Write results to this JSON file')
+    parser.add_argument('--baseline', help='Compare results with this JSON file')
+    parser.add_argument(
+        '--tolerance', type=float, default=DEFAULT_TOLERANCE,
+        help='Relative slowdown reported as a regression (default: {})'.format(DEFAULT_TOLERANCE)
+    )
+    parser.add_argument(
+        '--min-seconds', type=float, default=DEFAULT_MIN_SECONDS,
+        help='Do not compare benchmarks faster than this (default: {})'.format(DEFAULT_MIN_SECONDS)
+    )
+
+    args = parser.parse_args(args)
+
+    results = run_suite(args.work_dir, args.scale, args.repeat, args.group or BENCHMARK_GROUPS)
+
+    # Write results
+    if args.output is not None:
+        with open(args.output, 'w') as out_file:
+            json.dump(results, out_file, indent=2, sort_keys=True)
+            out_file.write('\n')
+
+    for name, result in sorted(results['results'].items()):
+        line = '{}\t{:.4f} s'.format(name, result['seconds'])
+
+        if 'throughput' in result:
+            line += '\t{:.1f} {}'.format(result['throughput'], result['unit'])
+
+        if 'cpu_per_gb' in result:
+            line += '\t{:.3f} CPU s/GB'.format(result['cpu_per_gb'])
+
+        if 'syscalls_per_entry' in result:
+            line += '\t{:.2f} syscalls/entry'.format(result['syscalls_per_entry'])
+
+        print(line)
+
+    # Compare
+    if args.baseline is None:
+        return 0
+
+    with open(args.baseline) as in_file:
+        baseline = json.load(in_file)
+
+    comparison = compare(results, baseline, args.tolerance, args.min_seconds)
+
+    print()
+
+    for name, base_seconds, seconds, ratio, status in comparison:
+        print('{}\t{:.4f} s -> {:.4f} s\t{:+.1f}%\t{}'.format(name, base_seconds, seconds, (ratio - 1) * 100, status))
+
+    return 1 if any(status == 'regression' for name, base_seconds, seconds, ratio, status in comparison) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,224 +2,1421 @@
 A collection of utilities for manipulating files.
 """
 
+import array
+import concurrent.futures
 import errno
+import fnmatch
+import functools
+import gzip
+import json
+import lzma
+import mmap
 import os
+import queue
 import re
 import time
 import shutil
 import stat
+import struct
+import sys
+import threading
+import zlib
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 
 # Some code copied from Python 2.7 (commit 102514:65eb8d0ede75)
 
-def make_abs_file(file_name, root_dir_name=None, check=True, allow_dir=True):
+
+# Linux ioctl request that clones (reflinks) a whole file (FICLONE from linux/fs.h)
+_FICLONE = 0x40049409
+
+# Maximum number of bytes requested from one copy_file_range() or sendfile() call
+_KERNEL_COPY_LENGTH = 2 ** 30
+
+# Target duration of one read/write cycle in an adaptive user-space copy
+_ADAPTIVE_CYCLE_TIME = 0.05
+
+# Default burst duration of a bandwidth governor
+_GOVERNOR_BURST_TIME = 0.1
+
+# Layout of bandwidth governor state shared between processes (theoretical arrival time and boot ID)
+_GOVERNOR_STATE = struct.Struct('d16s')
+
+# File holding a random ID of the running kernel, which changes when the host boots
+_BOOT_ID_FILE = '/proc/sys/kernel/random/boot_id'
+
+# Minimum length and alignment of the byte ranges in a parallel copy
+_PARALLEL_RANGE_MIN = 64 * 1024 ** 2
+_PARALLEL_RANGE_ALIGN = 1024 ** 2
+
+# Errors indicating that a kernel copy method does not work for a pair of files
+_KERNEL_COPY_UNSUPPORTED = frozenset(
+    code for code in (
+        errno.ENOSYS, errno.EINVAL, errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY, errno.ETXTBSY, errno.EBADF,
+        getattr(errno, 'ENOTSUP', None)
+    ) if code is not None
+)
+
+# Formats files can be compressed to while they are copied
+COMPRESS_FORMATS = ('gzip', 'bgzip', 'lzma')
+
+# Uncompressed length of a BGZF block (as bgzip writes them) and the empty block that marks the end of a BGZF file
+_BGZF_BLOCK_LENGTH = 0xff00
+_BGZF_HEADER = struct.Struct('<4BI2BH2BHH')
+_BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+
+def make_abs_file(file_name, root_dir_name=None, check=True, allow_dir=True):
+    """
+    Make filename into a normalized absolute file name.
+
+    :param file_name: Name of the file.
+    :param root_dir_name: Directory of the file or `None` to use the current working directory.
+    :param check: If `True`, raise `IOError` if the file does not exist or is not a regular file.
+    :param allow_dir: `True` if `file_name` may be a directory.
+
+    :return: Absolute file name.
+    """
+
+    if root_dir_name is None:
+        root_dir_name = os.getcwd()
+
+    file = os.path.normpath(os.path.join(root_dir_name, file_name))
+
+    if check:
+        if not os.path.exists(file):
+            raise IOError(errno.ENOENT, 'File does not exist', file)
+
+        if os.path.isdir(file):
+            if not allow_dir:
+                raise IOError(errno.EISDIR, 'Expected a file but found a directory', file)
+
+        else:
+            if not os.path.isfile(file):
+                raise IOError(errno.ENOENT, 'Not a regular file', file)
+
+    return file
+
+
+def _compile_pattern(pattern, glob=False):
+    """
+    Compile a pattern for matching file names or paths.
+
+    :param pattern: Regular expression, shell-style wildcard pattern if `glob` is set, compiled pattern object, or
+        `None` to match any string.
+    :param glob: Interpret `pattern` as a shell-style wildcard pattern (see `fnmatch`).
+
+    :return: A compiled pattern or `None` if the pattern matches any string.
+    """
+
+    if pattern is None:
+        return None
+
+    # Pass compiled patterns through
+    if hasattr(pattern, 'match'):
+        return pattern
+
+    if glob:
+        if pattern == '*':
+            return None
+
+        pattern = fnmatch.translate(pattern)
+
+    elif pattern in ('', '.*'):
+        return None
+
+    return re.compile(pattern)
+
+
+def _compile_any(pattern_list, glob=False):
+    """
+    Compile a list of patterns into one match function that succeeds if any pattern matches.
+
+    Patterns are merged into a single alternation so that the cost of matching does not grow with the number of
+    patterns. Patterns that cannot be merged, such as those with back-references or inline global flags, are matched
+    individually.
+
+    :param pattern_list: A list of regular expressions, shell-style wildcard patterns if `glob` is set, or compiled
+        pattern objects.
+    :param glob: Interpret patterns as shell-style wildcard patterns (see `fnmatch`).
+
+    :return: A function that takes a string and returns a true value if any pattern matches the start of it, or `None`
+        if `pattern_list` is empty.
+    """
+
+    if isinstance(pattern_list, str):
+        pattern_list = (pattern_list, )
+
+    source_list = list()
+    compiled_list = list()
+
+    for pattern in pattern_list:
+        if hasattr(pattern, 'match'):
+            compiled_list.append(pattern)
+
+        else:
+            if glob:
+                pattern = fnmatch.translate(pattern)
+
+            if re.search(r'\\[1-9]|\(\?P=', pattern):
+                compiled_list.append(re.compile(pattern))
+            else:
+                source_list.append(pattern)
+
+    # Merge patterns into one alternation
+    if source_list:
+        try:
+            compiled_list.append(re.compile('|'.join('(?:{})'.format(pattern) for pattern in source_list)))
+
+        except re.error:
+            compiled_list.extend(re.compile(pattern) for pattern in source_list)
+
+    if not compiled_list:
+        return None
+
+    if len(compiled_list) == 1:
+        return compiled_list[0].match
+
+    return lambda string: any(compiled.match(string) for compiled in compiled_list)
+
+
+class PathMatcher:
+    """
+    Match files against a base file name pattern, a path pattern, and a list of path filters. All patterns are compiled
+    once when the matcher is created, and path filters are merged into a single pattern, so a matcher can be reused for
+    any number of files.
+    """
+
+    def __init__(self, pattern=None, path_pattern=None, path_filter=(), glob=False):
+        """
+        Create a new `PathMatcher` object.
+
+        :param pattern: The base filename must match this regular expression, or `None` to match any file name.
+        :param path_pattern: The absolute path name to the file must match this regular expression, or `None` to match
+            any path.
+        :param path_filter: If a file path matches this regular expression, or any in this list of regular expressions,
+            then filter it out.
+        :param glob: Patterns are shell-style wildcard patterns (see `fnmatch`) instead of regular expressions. Unlike
+            regular expressions, wildcard patterns are anchored at both ends, and "*" also matches path separators.
+        """
+
+        self.glob = bool(glob)
+
+        self.__pattern = _compile_pattern(pattern, self.glob)
+        self.__path_pattern = _compile_pattern(path_pattern, self.glob)
+        self.__path_filter = _compile_any(path_filter, self.glob)
+
+    def match(self, file_name):
+        """
+        Determine if a file or its path matches patterns or if it should be filtered.
+
+        :param file_name: Full file path to check.
+
+        :return: `True` if the file passes, and `False` if it does not.
+        """
+
+        # Match file pattern
+        if self.__pattern is not None and not self.__pattern.match(os.path.basename(file_name)):
+            return False
+
+        # Match path pattern
+        if self.__path_pattern is not None and not self.__path_pattern.match(file_name):
+            return False
+
+        # Apply path filters
+        if self.filtered(file_name):
+            return False
+
+        # Accept file_name
+        return True
+
+    def filtered(self, path):
+        """
+        Determine if a path matches any path filter.
+
+        :param path: Path to check.
+
+        :return: `True` if any path filter matches `path`.
+        """
+
+        return self.__path_filter is not None and bool(self.__path_filter(path))
+
+
+def _path_match(file_name, pattern='.*', path_pattern='.*', path_filter=()):
+    """
+    Determine if a file or its path matches regex patterns or if it should be filtered.
+
+    :param file_name: Full file path to check.
+    :param pattern: Base file name must match this pattern.
+    :param path_pattern: Full file path must match this pattern.
+    :param path_filter: A list of filters that must not match the file path.
+
+    :return: `True` if the file passes, and `False` if it does not.
+    """
+
+    return PathMatcher(pattern, path_pattern, path_filter).match(file_name)
+
+
+def _dir_filtered(dir_name, dir_filter):
+    """
+    Determine if a directory should be pruned from a search.
+
+    :param dir_name: Absolute directory name without a trailing separator.
+    :param dir_filter: A list of match functions (see `_compile_any()`).
+
+    :return: `True` if the directory path, with a trailing separator, matches any filter.
+    """
+
+    dir_name += os.sep
+
+    for dir_filter_element in dir_filter:
+        if dir_filter_element(dir_name):
+            return True
+
+    return False
+
+
+def _list_dir(dir_name, follow_symlinks=True, dir_filter=(), index=None):
+    """
+    List the regular files and directories in a directory.
+
+    File types are read from the entries returned by `os.scandir()`, which most file systems fill in without a `stat`
+    call. Only symbolic links must be resolved with an additional system call.
+
+    :param dir_name: Absolute and normalized name of the directory.
+    :param follow_symlinks: Include symbolic links if set and skip them otherwise.
+    :param dir_filter: A list of match functions (see `_compile_any()`). Subdirectories whose path, with a trailing
+        separator, matches any of them are omitted.
+    :param index: A `_DirIndex` object to read unchanged directories from or `None` to always read the directory.
+
+    :return: A list of `(path, is_dir)` tuples in directory order. Entries that are neither a regular file nor a
+        directory (e.g. broken links, sockets, and named pipes) are omitted.
+    """
+
+    if index is not None:
+        return _list_dir_indexed(dir_name, follow_symlinks, dir_filter, index)
+
+    entry_list = []
+
+    with os.scandir(dir_name) as entry_iter:
+        for entry in entry_iter:
+
+            # Check symlink
+            if not follow_symlinks and entry.is_symlink():
+                continue
+
+            # Check for file or directory
+            try:
+                if entry.is_file():
+                    entry_list.append((entry.path, False))
+
+                elif entry.is_dir():
+                    if not _dir_filtered(entry.path, dir_filter):
+                        entry_list.append((entry.path, True))
+
+            except OSError:
+                # Entry was removed or cannot be resolved
+                pass
+
+    return entry_list
+
+
+def _list_dir_indexed(dir_name, follow_symlinks, dir_filter, index):
+    """
+    List the regular files and directories in a directory using a directory index. Entries that are symbolic links
+    are resolved on every call because a link target may change without changing the directory.
+
+    :param dir_name: Absolute and normalized name of the directory.
+    :param follow_symlinks: Include symbolic links if set and skip them otherwise.
+    :param dir_filter: A list of match functions (see `_compile_any()`).
+    :param index: A `_DirIndex` object.
+
+    :return: A list of `(path, is_dir)` tuples in directory order.
+    """
+
+    entry_list = []
+
+    for name, kind in index.scan(dir_name):
+        path = os.path.join(dir_name, name)
+
+        if kind == 'l':
+            # Check symlink
+            if not follow_symlinks:
+                continue
+
+            if os.path.isfile(path):
+                kind = 'f'
+
+            elif os.path.isdir(path):
+                kind = 'd'
+
+            else:
+                continue
+
+        if kind == 'f':
+            entry_list.append((path, False))
+
+        elif not _dir_filtered(path, dir_filter):
+            entry_list.append((path, True))
+
+    return entry_list
+
+
+class _DirIndex:
+    """
+    An on-disk index of directory listings. A directory is read again only if its modification time changed since it
+    was indexed, so repeated searches of a mostly static tree list only the directories that changed.
+
+    A listing is trusted only if it was taken at least `RACY_NS` nanoseconds after the directory modification time.
+    Directories modified within that window of being listed are read again on the next search, which protects against
+    file systems with coarse timestamps and against changes made while the directory was read.
+    """
+
+    VERSION = 1
+
+    RACY_NS = 2 * 10 ** 9
+
+    def __init__(self, index_file):
+        """
+        Create a new index and load any listings saved in `index_file`.
+
+        :param index_file: Index file name. The file does not need to exist.
+        """
+
+        self.index_file = os.path.abspath(index_file)
+
+        self.__dirs = dict()
+        self.__visited = dict()
+
+        # Read index. A missing, unreadable, or outdated index is rebuilt.
+        try:
+            with open(self.index_file, 'r') as in_file:
+                index_data = json.load(in_file)
+
+            if index_data.get('version') == self.VERSION:
+                self.__dirs = index_data['dirs']
+
+        except (OSError, ValueError, KeyError, AttributeError):
+            pass
+
+    def scan(self, dir_name):
+        """
+        Get the entries of a directory.
+
+        :param dir_name: Absolute and normalized name of the directory.
+
+        :return: A list of `(name, kind)` tuples where `kind` is "f" for a regular file, "d" for a directory, and "l"
+            for a symbolic link. Other entry types are omitted.
+        """
+
+        mtime_ns = os.stat(dir_name).st_mtime_ns
+
+        dir_record = self.__dirs.get(dir_name)
+
+        if dir_record is None or dir_record[0] != mtime_ns or dir_record[1] - mtime_ns < self.RACY_NS:
+
+            listed_ns = time.time_ns()
+
+            names = []
+            kinds = []
+
+            with os.scandir(dir_name) as entry_iter:
+                for entry in entry_iter:
+                    try:
+                        if entry.is_symlink():
+                            kinds.append('l')
+
+                        elif entry.is_file(follow_symlinks=False):
+                            kinds.append('f')
+
+                        elif entry.is_dir(follow_symlinks=False):
+                            kinds.append('d')
+
+                        else:
+                            continue
+
+                    except OSError:
+                        # Entry was removed
+                        continue
+
+                    names.append(entry.name)
+
+            dir_record = [mtime_ns, listed_ns, names, ''.join(kinds)]
+
+        self.__visited[dir_name] = dir_record
+
+        return zip(dir_record[2], dir_record[3])
+
+    def save(self):
+        """
+        Write listings of all directories scanned through this object to the index file. Directories that were not
+        scanned, such as those removed or filtered since the last search, are dropped from the index.
+        """
+
+        temp_file = '{}.{}.tmp'.format(self.index_file, os.getpid())
+
+        try:
+            with open(temp_file, 'w') as out_file:
+                json.dump({'version': self.VERSION, 'dirs': self.__visited}, out_file, separators=(',', ':'))
+
+            os.replace(temp_file, self.index_file)
+
+        finally:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+
+
+def iter_search_dir(search_dir_name, pattern='.*', path_pattern='.*', path_filter=(), follow_symlinks=True,
+                    dir_filter=(), prune=False, matcher=None, workers=None, ordered=True, index_file=None):
+    """
+    Recursively search a directory for files and yield each file as it is found.
+
+    Files are yielded in the same order `search_dir()` returns them. Directories are read with `os.scandir()`, and the
+    file type information it returns is reused, so the search costs at most one `stat` call per entry.
+
+    :param search_dir_name: Name of the search directory.
+    :param pattern: The base filename must match this regular expression. This pattern is not implicitly anchored, and
+        so this pattern may match any part of the file (use "^" and "$" to anchor).
+    :param path_pattern: The absolute path name to the file must match this regular expression. All others are ignored.
+        This pattern is not implicitly anchored, and so this pattern may match any part of the file (use "^" and "$" to
+        anchor).
+    :param path_filter: If a file path matches this regular expression, or any in this list of regular expressions
+        (argument may be a string or a list of strings), then filter it out.
+    :param follow_symlinks: Files and directories may be symbolic links if set.
+    :param dir_filter: If a directory path matches this regular expression, or any in this list of regular expressions,
+        then the directory is not searched. Directory paths are matched with a trailing separator (e.g.
+        "/path/to/.git/"), so a file path filter such as ".*/\\.git/.*" may also be used here. The search directory
+        itself is never filtered.
+    :param prune: If set, `path_filter` is also applied to directories as `dir_filter` is, and directories it matches
+        are not searched. This is only safe for filters that match a directory path regardless of what follows it,
+        such as ".*/\\.snakemake/.*".
+    :param matcher: A `PathMatcher` object to select files with. If set, `pattern`, `path_pattern`, and `path_filter`
+        are ignored.
+    :param workers: Number of threads listing directories concurrently. This hides metadata latency on network and
+        parallel file systems. If `None` or less than 2, directories are listed in the calling thread.
+    :param ordered: If set, files are returned in the same order as a search without `workers`. Otherwise, files are
+        returned in the order their directories are listed, which starts returning files sooner and holds fewer
+        directory listings in memory. Ignored if `workers` is not set.
+    :param index_file: Name of a directory index file. If set, directory listings and modification times are saved to
+        this file after a complete search, and a later search with the same file reads only directories that changed.
+        The results are the same as a search without an index. The index holds only directories visited by the last
+        search, so searches of different trees should use different index files.
+
+    :return: An iterator over absolute file names.
+    """
+
+    search_root = make_abs_file(search_dir_name)
+
+    # Compile patterns
+    if matcher is None:
+        matcher = PathMatcher(pattern, path_pattern, path_filter)
+
+    dir_filter = _compile_any(dir_filter)
+    dir_filter = (dir_filter, ) if dir_filter is not None else ()
+
+    if prune:
+        dir_filter += (matcher.filtered, )
+
+    # Check search directory
+    if os.path.islink(search_root) and not follow_symlinks:
+        raise IOError(errno.ENOENT,
+                      'Search directory is a link and symlinks are disabled: {}'.format(search_dir_name),
+                      search_dir_name)
+
+    # Search
+    index = _DirIndex(index_file) if index_file is not None else None
+
+    list_dir = functools.partial(_list_dir, follow_symlinks=follow_symlinks, dir_filter=dir_filter, index=index)
+
+    pool = None
+
+    if workers is not None and workers >= 2:
+        pool = concurrent.futures.ThreadPoolExecutor(workers)
+
+    if pool is None or ordered:
+        file_iter = _walk_dir(search_root, list_dir, pool)
+    else:
+        file_iter = _walk_dir_unordered(search_root, list_dir, pool)
+
+    try:
+        for this_file in file_iter:
+            # Check filters and yield
+            if matcher.match(this_file):
+                yield this_file
+
+        # Save index after a complete search
+        if index is not None:
+            index.save()
+
+    finally:
+        file_iter.close()
+
+        if pool is not None:
+            pool.shutdown()
+
+
+def _walk_dir(search_root, list_dir, pool=None):
+    """
+    Walk a directory tree depth-first and yield all files.
+
+    If a thread pool is given, every directory is submitted to the pool as soon as it is discovered, so directories are
+    listed concurrently while files are still yielded in the same order as a walk without a pool.
+
+    :param search_root: Absolute name of the search directory or file.
+    :param list_dir: Function that lists a directory (see `_list_dir()`).
+    :param pool: A `concurrent.futures.Executor` to list directories with or `None` to list them in this thread.
+
+    :return: An iterator over file names.
+    """
+
+    # Stack of (path, is_dir) tuples
+    search_files = [(search_root, os.path.isdir(search_root))]
+
+    # Directory listings submitted to the pool
+    pending = dict()
+
+    try:
+
+        # Iterate until search files are depleted
+        while search_files:
+
+            this_file, is_dir = search_files.pop()
+
+            if not is_dir:
+                yield this_file
+                continue
+
+            # Search directory
+            if this_file in pending:
+                entry_list = pending.pop(this_file).result()
+            else:
+                entry_list = list_dir(this_file)
+
+            if pool is not None:
+                for next_file, next_is_dir in entry_list:
+                    if next_is_dir:
+                        pending[next_file] = pool.submit(list_dir, next_file)
+
+            search_files.extend(entry_list)
+
+    finally:
+        for future in pending.values():
+            future.cancel()
+
+
+def _walk_dir_unordered(search_root, list_dir, pool):
+    """
+    Walk a directory tree with a thread pool and yield files in the order their directory listings complete.
+
+    :param search_root: Absolute name of the search directory or file.
+    :param list_dir: Function that lists a directory (see `_list_dir()`).
+    :param pool: A `concurrent.futures.Executor` to list directories with.
+
+    :return: An iterator over file names.
+    """
+
+    if not os.path.isdir(search_root):
+        yield search_root
+        return
+
+    # Completed listings are queued by the pool threads
+    done_queue = queue.Queue()
+    pending = set()
+
+    def submit(dir_name):
+        future = pool.submit(list_dir, dir_name)
+        pending.add(future)
+        future.add_done_callback(done_queue.put)
+
+    try:
+        submit(search_root)
+
+        while pending:
+            future = done_queue.get()
+            pending.discard(future)
+
+            for next_file, is_dir in future.result():
+                if is_dir:
+                    submit(next_file)
+                else:
+                    yield next_file
+
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+class PathStore:
+    """
+    A compact collection of absolute file paths. Each directory is stored once, and file names are packed into a
+    single buffer, so a large set of paths takes a fraction of the memory of a list of strings. Paths are converted to
+    strings only when they are accessed.
+
+    A `PathStore` supports `len()`, iteration in the order paths were added, indexing, and membership tests. Use
+    `sorted()` to iterate in sorted order.
+    """
+
+    def __init__(self, paths=()):
+        """
+        Create a new `PathStore` object.
+
+        :param paths: An iterable of paths to add.
+        """
+
+        self.__dir_list = []
+        self.__dir_id = dict()
+
+        self.__file_dir = array.array('I')
+        self.__name_buffer = bytearray()
+        self.__name_end = array.array('Q')
+
+        self.__sorted_index = None
+
+        for path in paths:
+            self.append(path)
+
+    def append(self, path):
+        """
+        Add a path.
+
+        :param path: Path to add.
+        """
+
+        dir_name, base_name = os.path.split(path)
+
+        dir_id = self.__dir_id.get(dir_name)
+
+        if dir_id is None:
+            dir_id = len(self.__dir_list)
+            self.__dir_list.append(dir_name)
+            self.__dir_id[dir_name] = dir_id
+
+        self.__file_dir.append(dir_id)
+        self.__name_buffer += os.fsencode(base_name)
+        self.__name_end.append(len(self.__name_buffer))
+
+        self.__sorted_index = None
+
+    def sorted(self):
+        """
+        Iterate over paths in sorted order.
+
+        The sort order is computed on the first call after paths are added and is kept for later calls and membership
+        tests. Computing it briefly holds all paths as strings.
+
+        :return: An iterator over paths.
+        """
+
+        for index in self.__get_sorted_index():
+            yield self[index]
+
+    def __get_sorted_index(self):
+        """
+        Get path indices in sorted path order.
+
+        :return: An array of indices.
+        """
+
+        if self.__sorted_index is None:
+            self.__sorted_index = array.array('Q', sorted(range(len(self)), key=self.__getitem__))
+
+        return self.__sorted_index
+
+    def __len__(self):
+        return len(self.__file_dir)
+
+    def __getitem__(self, index):
+
+        if index < 0:
+            index += len(self)
+
+        if not 0 <= index < len(self):
+            raise IndexError('PathStore index out of range: {}'.format(index))
+
+        name_start = self.__name_end[index - 1] if index > 0 else 0
+
+        return os.path.join(
+            self.__dir_list[self.__file_dir[index]],
+            os.fsdecode(bytes(self.__name_buffer[name_start:self.__name_end[index]]))
+        )
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def __contains__(self, path):
+
+        if not isinstance(path, str) or os.path.dirname(path) not in self.__dir_id:
+            return False
+
+        # Binary search in sorted order
+        sorted_index = self.__get_sorted_index()
+
+        low = 0
+        high = len(sorted_index)
+
+        while low < high:
+            mid = (low + high) // 2
+
+            if self[sorted_index[mid]] < path:
+                low = mid + 1
+            else:
+                high = mid
+
+        return low < len(sorted_index) and self[sorted_index[low]] == path
+
+    def __repr__(self):
+        return '[PathStore: files={}, dirs={}]'.format(len(self), len(self.__dir_list))
+
+
+def search_dir(search_dir_name, pattern='.*', path_pattern='.*', path_filter=(), follow_symlinks=True,
+               dir_filter=(), prune=False, matcher=None, workers=None, ordered=True, index_file=None,
+               compact=False):
+    """
+    Recursively search a directory for files and return a list of all files.
+
+    :param search_dir_name: Name of the search directory.
+    :param pattern: The base filename must match this regular expression. This pattern is not implicitly anchored, and
+        so this pattern may match any part of the file (use "^" and "$" to anchor).
+    :param path_pattern: The absolute path name to the file must match this regular expression. All others are ignored.
+        This pattern is not implicitly anchored, and so this pattern may match any part of the file (use "^" and "$" to
+        anchor).
+    :param path_filter: If a file path matches this regular expression, or any in this list of regular expressions
+        (argument may be a string or a list of strings), then filter it out.
+    :param follow_symlinks: Files and directories may be symbolic links if set.
+    :param dir_filter: If a directory path matches this regular expression, or any in this list of regular expressions,
+        then the directory is not searched. Directory paths are matched with a trailing separator (e.g.
+        "/path/to/.git/"), so a file path filter such as ".*/\\.git/.*" may also be used here. The search directory
+        itself is never filtered.
+    :param prune: If set, `path_filter` is also applied to directories as `dir_filter` is, and directories it matches
+        are not searched. This is only safe for filters that match a directory path regardless of what follows it,
+        such as ".*/\\.snakemake/.*".
+    :param matcher: A `PathMatcher` object to select files with. If set, `pattern`, `path_pattern`, and `path_filter`
+        are ignored.
+    :param workers: Number of threads listing directories concurrently. This hides metadata latency on network and
+        parallel file systems. If `None` or less than 2, directories are listed in the calling thread.
+    :param ordered: If set, files are returned in the same order as a search without `workers`. Otherwise, files are
+        returned in the order their directories are listed, which starts returning files sooner and holds fewer
+        directory listings in memory. Ignored if `workers` is not set.
+    :param index_file: Name of a directory index file. If set, directory listings and modification times are saved to
+        this file after a complete search, and a later search with the same file reads only directories that changed.
+        The results are the same as a search without an index. The index holds only directories visited by the last
+        search, so searches of different trees should use different index files.
+    :param compact: Return a `PathStore` instead of a list. This saves memory when searching large trees.
+
+    :return: A list of absolute file names, or a `PathStore` if `compact` is set.
+    """
+
+    file_iter = iter_search_dir(
+        search_dir_name, pattern, path_pattern, path_filter, follow_symlinks,
+        dir_filter=dir_filter, prune=prune, matcher=matcher, workers=workers, ordered=ordered, index_file=index_file
+    )
+
+    if compact:
+        return PathStore(file_iter)
+
+    return list(file_iter)
+
+
+def _parse_bandwidth(bw_spec):
+    """
+    Parse a bandwidth specification string. This value is a string that starts with an integer or floating-point
+    number followed by an optional multiplier. The multipiler, B, K, M, G, and T, specifies that the bandwidth is
+    given in bytes, kilobytes, megabytes, gigabytes, or terabytes, respectively. If a multiplier is not used, 'K'
+    is assumed.
+
+    :param bw_spec: Specification string.
+
+    :return: Bandwidth as an integer. This integer is always a multiple of 1024 and never less than 1024.
+    """
+
+    # Parse size specification
+
+    m = re.match("^([0-9]+(\.[0-9]+)?)([bkmgtBKMGT])?$", str(bw_spec))
+
+    if m is None:
+        raise ValueError('Unrecognized size specification: {}'.format(bw_spec))
+
+    bw_value = float(m.group(1))
+    multiplier = m.group(3)
+
+    # Apply multiplier to the base value
+    if multiplier is not None:
+        bw_value *= {'B': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}[multiplier.upper()]
+    else:
+        bw_value *= 1024
+
+    # Convert to an integer that is a multiplier of 1024
+    bw_value = int(bw_value / 1024) * 1024
+
+    if bw_value == 0:
+        bw_value = 1024
+
+    # Return bandwidth value
+    return bw_value
+
+
+@functools.lru_cache(maxsize=None)
+def _get_boot_id():
+    """
+    Get an ID of the current boot of this host.
+
+    :return: A 16-byte ID, or 16 zero bytes if the ID is not available on this system.
+    """
+
+    try:
+        with open(_BOOT_ID_FILE) as in_file:
+            return bytes.fromhex(in_file.read().strip().replace('-', ''))[:16].ljust(16, b'\0')
+
+    except (OSError, ValueError):
+        return bytes(16)
+
+
+class BandwidthGovernor:
+    """
+    Limit the combined transfer rate of any number of copies with a token bucket.
+
+    A copy takes tokens for each block it writes. Copies in the same process share a limit by passing the same governor
+    as their `bandwidth` argument. Copies in separate processes on the same host share a limit by creating governors
+    with the same `shared_file`, which holds the bucket state in shared memory locked with `fcntl.flock()`.
+
+    Each block is scheduled when it is taken from the bucket, and the copy sleeps only until that time, so the combined
+    rate stays smooth instead of alternating between bursts and long sleeps.
+    """
+
+    def __init__(self, bandwidth, burst=None, shared_file=None):
+        """
+        Create a new `BandwidthGovernor` object.
+
+        :param bandwidth: Combined bandwidth. A string that starts with an integer or floating-point number followed by
+            an optional multiplier, 'b', 'k', 'm', 'g', or 't' (see `_parse_bandwidth()`). If no multiplier is given or
+            if an integer is used, 'k' is assumed.
+        :param burst: Number of bytes that may be sent at once after the bucket has been idle. If `None`, the number of
+            bytes allowed in `_GOVERNOR_BURST_TIME` seconds is used, but not less than 64 KiB.
+        :param shared_file: Name of a file holding the bucket state. Governors created with the same file share one
+            bucket across processes on this host. If `None`, the bucket is shared only through this object. State
+            left in the file by an earlier boot of the host is discarded on systems that provide a boot ID (Linux).
+        """
+
+        self.bw_value = _parse_bandwidth(bandwidth)
+
+        if burst is None:
+            burst = max(int(self.bw_value * _GOVERNOR_BURST_TIME), 64 * 1024)
+
+        self.burst = int(burst)
+
+        if self.burst < 0:
+            raise ValueError('Burst size must not be negative: {}'.format(self.burst))
+
+        self.shared_file = shared_file
+
+        # Total time copies slept waiting for this governor, and time slept by each thread
+        self.sleep_time = 0.0
+        self.__thread_sleep = threading.local()
+
+        # Theoretical arrival time: The time when all bytes taken so far have been sent at the rate limit
+        self.__lock = threading.Lock()
+        self.__tat = 0.0
+
+        self.__shared_fd = None
+        self.__shared_map = None
+
+        if shared_file is not None:
+
+            if fcntl is None:
+                raise NotImplementedError('Shared bandwidth governors require fcntl, which is not available')
+
+            self.__shared_fd = os.open(shared_file, os.O_RDWR | os.O_CREAT, 0o666)
+
+            try:
+                fcntl.flock(self.__shared_fd, fcntl.LOCK_EX)
+
+                try:
+                    if os.fstat(self.__shared_fd).st_size < _GOVERNOR_STATE.size:
+                        os.ftruncate(self.__shared_fd, _GOVERNOR_STATE.size)
+
+                finally:
+                    fcntl.flock(self.__shared_fd, fcntl.LOCK_UN)
+
+                self.__shared_map = mmap.mmap(self.__shared_fd, _GOVERNOR_STATE.size)
+
+            except Exception:
+                os.close(self.__shared_fd)
+                raise
+
+    def consume(self, n_bytes):
+        """
+        Take bytes from the bucket and sleep until sending them stays within the rate limit.
+
+        :param n_bytes: Number of bytes.
+
+        :return: Number of seconds slept.
+        """
+
+        with self.__lock:
+
+            if self.__shared_map is not None:
+                fcntl.flock(self.__shared_fd, fcntl.LOCK_EX)
+
+            try:
+                if self.__shared_map is not None:
+                    tat, boot_id = _GOVERNOR_STATE.unpack_from(self.__shared_map)
+
+                    # The monotonic clock restarts when the host boots, so state left by an earlier boot is discarded
+                    if boot_id != _get_boot_id():
+                        tat = 0.0
+
+                else:
+                    tat = self.__tat
+
+                # The monotonic clock is system-wide, so shared state is valid in all processes
+                now = time.monotonic()
+                tat = max(tat, now) + n_bytes / self.bw_value
+
+                if self.__shared_map is not None:
+                    _GOVERNOR_STATE.pack_into(self.__shared_map, 0, tat, _get_boot_id())
+                else:
+                    self.__tat = tat
+
+            finally:
+                if self.__shared_map is not None:
+                    fcntl.flock(self.__shared_fd, fcntl.LOCK_UN)
+
+        # Sleep until bytes in excess of the burst size are sent
+        wait_time = tat - now - self.burst / self.bw_value
+
+        if wait_time <= 0:
+            return 0.0
+
+        time.sleep(wait_time)
+
+        self.sleep_time += wait_time
+        self.__thread_sleep.sleep_time = getattr(self.__thread_sleep, 'sleep_time', 0.0) + wait_time
+
+        return wait_time
+
+    def get_thread_sleep_time(self):
+        """
+        Get the time the calling thread slept waiting for this governor. Unlike `sleep_time`, this does not include
+        copies in other threads sharing the governor.
+
+        :return: Number of seconds slept.
+        """
+
+        return getattr(self.__thread_sleep, 'sleep_time', 0.0)
+
+    def close(self):
+        """
+        Release the shared bucket state. The governor must not be used after it is closed.
+        """
+
+        if self.__shared_map is not None:
+            self.__shared_map.close()
+            self.__shared_map = None
+
+        if self.__shared_fd is not None:
+            os.close(self.__shared_fd)
+            self.__shared_fd = None
+
+    def __repr__(self):
+        return '[BandwidthGovernor: bandwidth={}, burst={}, shared_file={}]'.format(
+            self.bw_value, self.burst, self.shared_file
+        )
+
+
+def _get_governor(bandwidth):
+    """
+    Get a governor for a bandwidth argument.
+
+    :param bandwidth: A `BandwidthGovernor`, a bandwidth specification (see `_parse_bandwidth()`), or `None`.
+
+    :return: `bandwidth` if it is a `BandwidthGovernor`, a new governor used by one copy if it is a specification, or
+        `None` if it is `None`.
+    """
+
+    if bandwidth is None or isinstance(bandwidth, BandwidthGovernor):
+        return bandwidth
+
+    return BandwidthGovernor(bandwidth)
+
+
+def _copyfileobj_bwlimited(fsrc, fdst, bandwidth, length=16*1024, digest=None):
+    """
+    Copy data from file-like object `fsrc` to file-like object `fdst`.
+
+    :param fsrc: Source.
+    :param fdst: Destination.
+    :param bandwidth: Bandwidth specification (see `_parse_bandwidth()`) or a `BandwidthGovernor`.
+    :param length: Buffer length.
+    :param digest: A hash object (see `hashlib`) updated with all copied bytes or `None`.
+    """
+
+    governor = _get_governor(bandwidth)
+
+    # Copy
+    while 1:
+        buf = fsrc.read(length)
+
+        # Check for EOF
+        if not buf:
+            break
+
+        # Limit bandwidth
+        governor.consume(len(buf))
+
+        # Copy
+        fdst.write(buf)
+
+        if digest is not None:
+            digest.update(buf)
+
+
+def _copyfileobj_adaptive(fsrc, fdst, length=16*1024, max_length=1024*1024, bandwidth=None, digest=None):
     """
-    Make filename into a normalized absolute file name.
+    Copy data from file-like object `fsrc` to file-like object `fdst` through one reused buffer.
 
-    :param file_name: Name of the file.
-    :param root_dir_name: Directory of the file or `None` to use the current working directory.
-    :param check: If `True`, raise `IOError` if the file does not exist or is not a regular file.
-    :param allow_dir: `True` if `file_name` may be a directory.
+    Data is read with `readinto()` if `fsrc` supports it, so no objects are allocated for each read. The read length
+    starts at `length` and doubles, up to `max_length`, while a read/write cycle takes less than half of
+    `_ADAPTIVE_CYCLE_TIME`. A cycle that short means throughput is limited by per-call overhead rather than by the
+    files. If bandwidth is limited, the read length is also kept below the bytes allowed in one cycle.
 
-    :return: Absolute file name.
+    :param fsrc: Source.
+    :param fdst: Destination.
+    :param length: Initial buffer length.
+    :param max_length: Maximum buffer length.
+    :param bandwidth: Bandwidth specification (see `_parse_bandwidth()`), a `BandwidthGovernor`, or `None` to copy at
+        full speed.
+    :param digest: A hash object (see `hashlib`) updated with all copied bytes or `None`.
     """
 
-    if root_dir_name is None:
-        root_dir_name = os.getcwd()
+    governor = _get_governor(bandwidth)
 
-    file = os.path.normpath(os.path.join(root_dir_name, file_name))
+    if governor is not None:
+        max_length = min(max_length, int(governor.bw_value * _ADAPTIVE_CYCLE_TIME))
 
-    if check:
-        if not os.path.exists(file):
-            raise IOError(errno.ENOENT, 'File does not exist', file)
+    max_length = max(length, max_length)
 
-        if os.path.isdir(file):
-            if not allow_dir:
-                raise IOError(errno.EISDIR, 'Expected a file but found a directory', file)
+    # Allocate buffer
+    readinto = getattr(fsrc, 'readinto', None)
+
+    if readinto is not None:
+        buf_view = memoryview(bytearray(max_length))
+
+    # Copy
+    while 1:
+        cycle_start = time.time()
+
+        if readinto is not None:
+            n_bytes = readinto(buf_view[:length])
+
+            # Check for EOF
+            if not n_bytes:
+                break
+
+            cycle_time = time.time() - cycle_start
+
+            # Limit bandwidth
+            if governor is not None:
+                governor.consume(n_bytes)
+
+            write_start = time.time()
+            fdst.write(buf_view[:n_bytes])
+
+            if digest is not None:
+                digest.update(buf_view[:n_bytes])
 
         else:
-            if not os.path.isfile(file):
-                raise IOError(errno.ENOENT, 'Not a regular file', file)
+            buf = fsrc.read(length)
 
-    return file
+            # Check for EOF
+            if not buf:
+                break
 
+            n_bytes = len(buf)
 
-def _path_match(file_name, pattern='.*', path_pattern='.*', path_filter=()):
-    """
-    Determine if a file or its path matches regex patterns or if it should be filtered.
+            cycle_time = time.time() - cycle_start
 
-    :param file_name: Full file path to check.
-    :param pattern: Base file name must match this pattern.
-    :param path_pattern: Full file path must match this pattern.
-    :param path_filter: A list of filters that must not match the file path.
+            # Limit bandwidth
+            if governor is not None:
+                governor.consume(n_bytes)
 
-    :return: `True` if the file passes, and `False` if it does not.
-    """
+            write_start = time.time()
+            fdst.write(buf)
 
-    # Match file pattern
-    if not re.match(pattern, os.path.basename(file_name)):
-        return False
+            if digest is not None:
+                digest.update(buf)
 
-    # Match path pattern
-    if not re.match(path_pattern, file_name):
-        return False
+        # Grow buffer. Time spent waiting for the governor is not counted.
+        cycle_time += time.time() - write_start
 
-    # Apply path filters
-    for path_filter_element in path_filter:
-        if re.match(path_filter_element, file_name):
-            return False
+        if length < max_length and cycle_time < _ADAPTIVE_CYCLE_TIME / 2:
+            length = min(length * 2, max_length)
 
-    # Accept file_name
-    return True
 
+def _copyfileobj_pipelined(fsrc, fdst, length=1024*1024, depth=4, bandwidth=None, digest=None):
+    """
+    Copy data from file-like object `fsrc` to file-like object `fdst` with a reader thread. The reader fills a bounded
+    set of `depth` buffers while the calling thread writes them, so reading and writing overlap. An exception raised
+    by either side stops the copy and is raised in the calling thread.
 
-def search_dir(search_dir_name, pattern='.*', path_pattern='.*', path_filter=(), follow_symlinks=True):
+    :param fsrc: Source. Read from a separate thread.
+    :param fdst: Destination.
+    :param length: Length of each buffer.
+    :param depth: Number of buffers.
+    :param bandwidth: Bandwidth specification (see `_parse_bandwidth()`), a `BandwidthGovernor`, or `None` to copy at
+        full speed.
+    :param digest: A hash object (see `hashlib`) updated with all copied bytes or `None`. The digest is updated by the
+        calling thread while the reader thread reads the next buffer.
     """
-    Recursively search a directory for files and return a list of all files.
 
-    :param search_dir_name: Name of the search directory.
-    :param pattern: The base filename must match this regular expression. This pattern is not implicitly anchored, and
-        so this pattern may match any part of the file (use "^" and "$" to anchor).
-    :param path_pattern: The absolute path name to the file must match this regular expression. All others are ignored.
-        This pattern is not implicitly anchored, and so this pattern may match any part of the file (use "^" and "$" to
-        anchor).
-    :param path_filter: If a file path matches this regular expression, or any in this list of regular expressions
-        (argument may be a string or a list of strings), then filter it out.
-    :param follow_symlinks: Files and directories may be symbolic links if set.
+    governor = _get_governor(bandwidth)
+
+    readinto = getattr(fsrc, 'readinto', None)
+
+    # Buffers ready for the reader, and buffers ready for the writer as (buffer, data, n_bytes, exception) tuples
+    free_queue = queue.Queue()
+    full_queue = queue.Queue()
+
+    for count in range(max(depth, 1)):
+        free_queue.put(bytearray(length) if readinto is not None else count)
+
+    def reader():
+        try:
+            while 1:
+                buf = free_queue.get()
+
+                # Writer stopped
+                if buf is None:
+                    return
+
+                if readinto is not None:
+                    data = buf
+                    n_bytes = readinto(buf)
+                else:
+                    data = fsrc.read(length)
+                    n_bytes = len(data)
+
+                # Check for EOF
+                if not n_bytes:
+                    full_queue.put((None, None, 0, None))
+                    return
+
+                full_queue.put((buf, data, n_bytes, None))
+
+        except BaseException as ex:
+            full_queue.put((None, None, 0, ex))
+
+    reader_thread = threading.Thread(target=reader, name='copyfileobj-reader', daemon=True)
+    reader_thread.start()
+
+    try:
+        while 1:
+            buf, data, n_bytes, ex = full_queue.get()
+
+            if ex is not None:
+                raise ex
 
-    :return: A list of absolute file names.
+            # Check for EOF
+            if buf is None:
+                break
+
+            # Limit bandwidth
+            if governor is not None:
+                governor.consume(n_bytes)
+
+            # Copy
+            fdst.write(memoryview(data)[:n_bytes])
+
+            if digest is not None:
+                digest.update(memoryview(data)[:n_bytes])
+
+            free_queue.put(buf)
+
+    finally:
+        # Stop the reader if it is waiting for a buffer
+        free_queue.put(None)
+        reader_thread.join()
+
+
+class _BgzfCompressor:
+    """
+    Compress to BGZF, the blocked gzip format written by `bgzip` and read by samtools, tabix, and htslib. Each block is
+    a gzip member of up to 65280 uncompressed bytes with its compressed size in a "BC" extra field, so the file can be
+    read by any gzip reader and indexed for random access. Has the `compress()` and `flush()` methods of
+    `zlib.compressobj()`.
     """
 
-    all_files = []
+    def __init__(self, level=6):
+        """
+        Create a new `_BgzfCompressor` object.
 
-    search_files = [make_abs_file(search_dir_name)]
+        :param level: zlib compression level.
+        """
 
-    # Set path filter
-    if isinstance(path_filter, str):
-        path_filter = (path_filter, )
+        self.level = level
+        self.__buf = bytearray()
 
-    # Check search directory
-    if os.path.islink(search_files[0]) and not follow_symlinks:
-        raise IOError(errno.ENOENT,
-                      'Search directory is a link and symlinks are disabled: {}'.format(search_dir_name),
-                      search_dir_name)
+    def compress(self, data):
+        """
+        Compress data.
 
-    # Iterate until search files are depleted
-    while search_files:
+        :param data: Uncompressed bytes.
 
-        this_file = search_files.pop()
+        :return: Complete blocks, which may be empty.
+        """
 
-        if os.path.isfile(this_file):
-            # Check filters and append
-            if _path_match(this_file, pattern, path_pattern, path_filter):
-                all_files.append(this_file)
+        self.__buf += data
 
-        else:
-            # Search directory
-            for next_file in os.listdir(this_file):
+        block_list = list()
 
-                next_file = make_abs_file(next_file, this_file)
+        while len(self.__buf) >= _BGZF_BLOCK_LENGTH:
+            block_list.append(self.__compress_block(self.__buf[:_BGZF_BLOCK_LENGTH]))
+            del self.__buf[:_BGZF_BLOCK_LENGTH]
 
-                # Check symlink
-                if not follow_symlinks and os.path.islink(next_file):
-                    continue
+        return b''.join(block_list)
 
-                # Check for file or directory
-                if os.path.isfile(next_file) or os.path.isdir(next_file):
-                    search_files.append(next_file)
+    def flush(self):
+        """
+        Compress remaining data and end the file.
 
-    return all_files
+        :return: Last block and the end-of-file block.
+        """
 
+        block = self.__compress_block(self.__buf) if self.__buf else b''
+        self.__buf = bytearray()
 
-def _parse_bandwidth(bw_spec):
+        return block + _BGZF_EOF
+
+    def __compress_block(self, data):
+        """
+        Compress one block.
+
+        :param data: Uncompressed bytes, at most `_BGZF_BLOCK_LENGTH`.
+
+        :return: Compressed block.
+        """
+
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+        cdata = compressor.compress(data) + compressor.flush()
+
+        # ID1, ID2, CM, FLG, MTIME, XFL, OS, XLEN, SI1, SI2, SLEN, BSIZE - 1
+        header = _BGZF_HEADER.pack(31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, _BGZF_HEADER.size + len(cdata) + 8 - 1)
+
+        return header + cdata + struct.pack('<II', zlib.crc32(data), len(data))
+
+
+def _new_compressor(compress):
     """
-    Parse a bandwidth specification string. This value is a string that starts with an integer or floating-point
-    number followed by an optional multiplier. The multipiler, B, K, M, G, and T, specifies that the bandwidth is
-    given in bytes, kilobytes, megabytes, gigabytes, or terabytes, respectively. If a multiplier is not used, 'K'
-    is assumed.
+    Get a compressor.
 
-    :param bw_spec: Specification string.
+    :param compress: Format (see `COMPRESS_FORMATS`).
 
-    :return: Bandwidth as an integer. This integer is always a multiple of 1024 and never less than 1024.
+    :return: An object with the `compress()` and `flush()` methods of `zlib.compressobj()`.
     """
 
-    # Parse size specification
+    if compress == 'gzip':
+        return zlib.compressobj(6, zlib.DEFLATED, 31)
 
-    m = re.match("^([0-9]+(\.[0-9]+)?)([bkmgtBKMGT])?$", str(bw_spec))
+    if compress == 'bgzip':
+        return _BgzfCompressor()
 
-    if m is None:
-        raise ValueError('Unrecognized size specification: {}'.format(bw_spec))
+    if compress == 'lzma':
+        return lzma.LZMACompressor()
 
-    bw_value = float(m.group(1))
-    multiplier = m.group(3)
+    raise ValueError('Compression format must be one of {}: {}'.format(', '.join(COMPRESS_FORMATS), compress))
 
-    # Apply multiplier to the base value
-    if multiplier is not None:
-        bw_value *= {'B': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}[multiplier.upper()]
-    else:
-        bw_value *= 1024
 
-    # Convert to an integer that is a multiplier of 1024
-    bw_value = int(bw_value / 1024) * 1024
+def _open_decompressed(file_name, compress):
+    """
+    Open a compressed file for reading uncompressed data.
 
-    if bw_value == 0:
-        bw_value = 1024
+    :param file_name: File name.
+    :param compress: Format (see `COMPRESS_FORMATS`). BGZF files are read as gzip files.
 
-    # Return bandwidth value
-    return bw_value
+    :return: Binary file object.
+    """
+
+    if compress in ('gzip', 'bgzip'):
+        return gzip.open(file_name, 'rb')
+
+    if compress == 'lzma':
+        return lzma.open(file_name, 'rb')
+
+    raise ValueError('Compression format must be one of {}: {}'.format(', '.join(COMPRESS_FORMATS), compress))
 
 
-def _copyfileobj_bwlimited(fsrc, fdst, bandwidth, length=16*1024):
+def _copyfileobj_compressed(fsrc, fdst, compress, length=1024*1024, bandwidth=None, digest=None):
     """
-    Copy data from file-like object `fsrc` to file-like object `fdst`.
+    Compress data from `fsrc` while copying it to `fdst`. Data is compressed as it is read, so the compressed file is
+    never stored, and `bandwidth` limits the rate of compressed bytes written.
 
     :param fsrc: Source.
     :param fdst: Destination.
-    :param bandwidth: Bandwidth in bytes per second.
+    :param compress: Format (see `COMPRESS_FORMATS`).
     :param length: Buffer length.
+    :param bandwidth: Bandwidth specification (see `_parse_bandwidth()`) or a `BandwidthGovernor`, or `None` to copy
+        at full speed.
+    :param digest: A hash object (see `hashlib`) to update with all uncompressed bytes, or `None`.
     """
 
-    # Parse bandwidth specification
-    bw_value = _parse_bandwidth(bandwidth)
-
-    # Initialize time and size tracking
-    bytes_copied = 0
-    start_time = time.time()
+    compressor = _new_compressor(compress)
+    governor = _get_governor(bandwidth)
 
-    # Copy
-    while 1:
+    while True:
         buf = fsrc.read(length)
 
-        # Check for EOF
-        if not buf:
-            break
+        if buf:
+            if digest is not None:
+                digest.update(buf)
 
-        # Update length
-        bytes_copied += len(buf)
+            out_buf = compressor.compress(buf)
 
-        # Copy
-        fdst.write(buf)
+        else:
+            out_buf = compressor.flush()
 
-        # Sleep to limit bandwidth
-        wait_time = (bytes_copied + length / 2) / bw_value - (time.time() - start_time)
+        if out_buf:
+            if governor is not None:
+                governor.consume(len(out_buf))
 
-        if wait_time > 0.01:
-            time.sleep(wait_time)
+            fdst.write(out_buf)
+
+        if not buf:
+            break
 
 
-def copyfileobj(fsrc, fdst, length=16*1024, bandwidth=None):
+def copyfileobj(fsrc, fdst, length=16*1024, bandwidth=None, adaptive=False, max_length=1024*1024, digest=None,
+                compress=None):
     """
     Copy data from file-like object `fsrc` to file-like object `fdst`.
 
     :param fsrc: Source.
     :param fdst: Destination.
     :param length: Buffer length.
-    :param bandwidth: Bandwidth in bytes per second.
+    :param bandwidth: Bandwidth specification (see `_parse_bandwidth()`) or a `BandwidthGovernor` to limit the copy
+        rate, or `None` to copy at full speed.
+    :param adaptive: Copy through one reused buffer and grow the buffer from `length` up to `max_length` while larger
+        reads increase throughput (see `_copyfileobj_adaptive()`).
+    :param max_length: Maximum buffer length if `adaptive` is set.
+    :param digest: A hash object (see `hashlib`) to update with all copied bytes, or `None`. This computes a checksum of
+        the data without reading it again.
+    :param compress: Compress data while it is copied to this format (see `COMPRESS_FORMATS`), or `None` to copy it
+        unchanged. "bgzip" writes BGZF, which tools that read bgzip files can index. `digest` is computed on the
+        uncompressed data, and data is read in blocks of `max_length`.
     """
 
     # Base code from Python 2.7 (commit 102514:65eb8d0ede75)
 
-    if bandwidth is None:
+    if compress is not None:
+        _copyfileobj_compressed(fsrc, fdst, compress, max_length, bandwidth, digest)
+
+    elif adaptive:
+        _copyfileobj_adaptive(fsrc, fdst, length, max_length, bandwidth, digest)
+
+    elif bandwidth is None:
         while 1:
             buf = fsrc.read(length)
 
@@ -228,8 +1425,11 @@ def copyfileobj(fsrc, fdst, length=16*1024, bandwidth=None):
 
             fdst.write(buf)
 
+            if digest is not None:
+                digest.update(buf)
+
     else:
-        _copyfileobj_bwlimited(fsrc, fdst, bandwidth, length)
+        _copyfileobj_bwlimited(fsrc, fdst, bandwidth, length, digest)
 
 
 def _samefile(src, dst):
@@ -256,17 +1456,316 @@ def _samefile(src, dst):
             os.path.normcase(os.path.abspath(dst)))
 
 
-def copyfile(src, dst, bandwidth=None):
+def _copyfile_kernel(fsrc, fdst, offset=0):
+    """
+    Copy a file without moving data through user space. Methods are tried in order: reflink (FICLONE), which shares
+    blocks on file systems that support it, `os.copy_file_range()`, and `os.sendfile()`. A method that is not supported
+    for the pair of files falls through to the next one, which continues from where the last one stopped.
+
+    :param fsrc: Source file object opened for reading.
+    :param fdst: Destination file object opened for writing. The destination must be empty or end at `offset`.
+    :param offset: Copy from this offset. Reflink clones whole files, so it is only tried if `offset` is 0.
+
+    :return: A tuple of the name of the method that completed the copy ("reflink", "copy_file_range", or "sendfile"),
+        or `None` if no method completed it, and the number of bytes copied. If the method is `None`, the file
+        positions of `fsrc` and `fdst` are set to the number of bytes copied so the copy can be completed in user
+        space.
+    """
+
+    src_fd = fsrc.fileno()
+    dst_fd = fdst.fileno()
+
+    start_offset = offset
+
+    # Reflink
+    if fcntl is not None and sys.platform.startswith('linux') and offset == 0:
+        try:
+            fcntl.ioctl(dst_fd, _FICLONE, src_fd)
+            return 'reflink', os.fstat(dst_fd).st_size
+
+        except OSError as ex:
+            if ex.errno not in _KERNEL_COPY_UNSUPPORTED:
+                raise
+
+    # In-kernel copy
+    for method in ('copy_file_range', 'sendfile'):
+
+        if not hasattr(os, method):
+            continue
+
+        try:
+            if method == 'sendfile':
+                os.lseek(dst_fd, offset, os.SEEK_SET)
+
+            while True:
+                if method == 'copy_file_range':
+                    n_bytes = os.copy_file_range(src_fd, dst_fd, _KERNEL_COPY_LENGTH, offset, offset)
+                else:
+                    n_bytes = os.sendfile(dst_fd, src_fd, offset, _KERNEL_COPY_LENGTH)
+
+                # Check for EOF. Some special file systems (e.g. procfs) report no data to kernel copies, so a
+                # method that copies nothing does not complete the copy.
+                if n_bytes == 0:
+                    break
+
+                offset += n_bytes
+
+        except OSError as ex:
+            if ex.errno not in _KERNEL_COPY_UNSUPPORTED:
+                raise
+
+            continue
+
+        if offset > start_offset:
+            return method, offset
+
+    # Position files for a user-space copy
+    fsrc.seek(offset)
+    fdst.seek(offset)
+
+    return None, offset
+
+
+def _copy_range(src_fd, dst_fd, offset, size, length=1024*1024, governor=None, retry=2):
+    """
+    Copy a byte range from one file descriptor to another with `os.pread()` and `os.pwrite()`, then read the range back
+    from the destination and compare its CRC-32 with the CRC-32 of the source bytes. If the copy or the check fails, the
+    range is copied again up to `retry` more times.
+
+    :param src_fd: Source file descriptor.
+    :param dst_fd: Destination file descriptor.
+    :param offset: Offset of the range.
+    :param size: Number of bytes in the range.
+    :param length: Buffer length.
+    :param governor: A `BandwidthGovernor` or `None` to copy at full speed.
+    :param retry: Number of times to retry the range after the first attempt.
+
+    :return: CRC-32 of the range.
+    """
+
+    n_try = 0
+
+    while 1:
+        try:
+            bytes_copied = 0
+            src_crc = 0
+
+            # Copy
+            while bytes_copied < size:
+                buf = os.pread(src_fd, min(length, size - bytes_copied), offset + bytes_copied)
+
+                if not buf:
+                    raise IOError(errno.EIO, 'Source file was truncated during copy at offset {}'.format(
+                        offset + bytes_copied
+                    ))
+
+                src_crc = zlib.crc32(buf, src_crc)
+
+                # Limit bandwidth
+                if governor is not None:
+                    governor.consume(len(buf))
+
+                buf_view = memoryview(buf)
+
+                while buf_view:
+                    n_bytes = os.pwrite(dst_fd, buf_view, offset + bytes_copied)
+                    buf_view = buf_view[n_bytes:]
+                    bytes_copied += n_bytes
+
+            # Check destination
+            dst_crc = 0
+            bytes_checked = 0
+
+            while bytes_checked < size:
+                buf = os.pread(dst_fd, min(length, size - bytes_checked), offset + bytes_checked)
+
+                if not buf:
+                    break
+
+                dst_crc = zlib.crc32(buf, dst_crc)
+                bytes_checked += len(buf)
+
+            if bytes_checked != size or dst_crc != src_crc:
+                raise IOError(
+                    errno.EIO,
+                    'Checksum mismatch in range {}-{}: Source=0x{:08x}, Destination=0x{:08x}'.format(
+                        offset, offset + size, src_crc, dst_crc
+                    )
+                )
+
+            return src_crc
+
+        except EnvironmentError:
+            if n_try >= retry:
+                raise
+
+            n_try += 1
+
+
+def _copyfile_parallel(src_fd, dst_fd, n_threads, bandwidth=None, offset=0):
+    """
+    Copy a file with concurrent streams. The destination is preallocated, and disjoint byte ranges are copied by a
+    thread pool (see `_copy_range()`), so a failed range is retried without copying other ranges again.
+
+    :param src_fd: Source file descriptor.
+    :param dst_fd: Destination file descriptor opened for reading and writing.
+    :param n_threads: Number of concurrent streams.
+    :param bandwidth: Bandwidth specification (see `_parse_bandwidth()`) or a `BandwidthGovernor` shared by all
+        streams, or `None` to copy at full speed.
+    :param offset: Copy from this offset. Bytes of the destination before it are kept.
+
+    :return: A list of `(offset, size, crc32)` tuples, one for each range.
+    """
+
+    size = os.fstat(src_fd).st_size
+
+    governor = _get_governor(bandwidth)
+
+    # Preallocate destination
+    if size > offset and hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(dst_fd, offset, size - offset)
+
+        except OSError as ex:
+            if ex.errno not in _KERNEL_COPY_UNSUPPORTED:
+                raise
+
+    os.ftruncate(dst_fd, size)
+
+    # Split into ranges. Using more ranges than threads keeps all threads busy until the end of the copy.
+    range_length = max(_PARALLEL_RANGE_MIN, -(-(size - offset) // (n_threads * 4)))
+    range_length = -(-range_length // _PARALLEL_RANGE_ALIGN) * _PARALLEL_RANGE_ALIGN
+
+    range_list = [
+        (range_offset, min(range_length, size - range_offset))
+        for range_offset in range(offset, size, range_length)
+    ]
+
+    # Copy
+    with concurrent.futures.ThreadPoolExecutor(n_threads) as pool:
+        future_list = [
+            pool.submit(_copy_range, src_fd, dst_fd, offset, range_size, governor=governor)
+            for offset, range_size in range_list
+        ]
+
+        try:
+            return [
+                (offset, range_size, future.result())
+                for (offset, range_size), future in zip(range_list, future_list)
+            ]
+
+        finally:
+            for future in future_list:
+                future.cancel()
+
+
+def _copyfile_delta(src, dst, length=4*1024*1024, bandwidth=None, digest=None):
+    """
+    Update an existing file in place to match a source file, like `rsync --inplace`. Both files are read in blocks,
+    and only blocks of `dst` that differ from `src` are written. The destination is truncated to the size of the
+    source. Data read from and written to `dst` counts against `bandwidth`.
+
+    This saves writes when `dst` is mostly identical to `src`, such as an output regenerated by a rerun, but `dst` is
+    modified in place and is not consistent until the copy completes.
+
+    :param src: Source file.
+    :param dst: Destination file. Must exist.
+    :param length: Block length.
+    :param bandwidth: Bandwidth specification (see `_parse_bandwidth()`) or a `BandwidthGovernor`, or `None` to copy
+        at full speed.
+    :param digest: A hash object (see `hashlib`) to update with all bytes of `src`, or `None`.
+
+    :return: Number of bytes written to `dst`.
+    """
+
+    governor = _get_governor(bandwidth)
+
+    bytes_written = 0
+    offset = 0
+
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'r+b') as fdst:
+            while True:
+                buf = fsrc.read(length)
+
+                if not buf:
+                    break
+
+                if digest is not None:
+                    digest.update(buf)
+
+                dst_buf = fdst.read(len(buf))
+
+                if governor is not None:
+                    governor.consume(len(dst_buf))
+
+                # Rewrite block
+                if dst_buf != buf:
+                    if governor is not None:
+                        governor.consume(len(buf))
+
+                    fdst.seek(offset)
+                    fdst.write(buf)
+
+                    bytes_written += len(buf)
+
+                offset += len(buf)
+
+            fdst.truncate(offset)
+
+    return bytes_written
+
+
+def copyfile(src, dst, bandwidth=None, fast=True, pipeline=False, parallel=None, digest=None, offset=0,
+             compress=None, metrics=None):
     """
     Copy data from src to dst.
 
+    If `bandwidth` is not set, data is copied by the kernel if possible (see `_copyfile_kernel()`), and in user space
+    if not.
+
     :param src: Source file.
     :param dst: Destination file.
-    :param bandwidth: Limit copy rate to bandwidth KB/s if not 'None'.
+    :param bandwidth: Limit copy rate to bandwidth KB/s if not 'None'. May be a `BandwidthGovernor` to share a limit
+        with other copies.
+    :param fast: Try kernel copy methods if `bandwidth` is not set. If `False`, always copy in user space.
+    :param pipeline: Copy in user space with a reader thread so that reads from `src` overlap writes to `dst` (see
+        `_copyfileobj_pipelined()`). This is faster when `src` and `dst` are on different devices, such as local
+        scratch and a network mount. Kernel copy methods are not tried.
+    :param parallel: Copy with this number of concurrent streams, each copying a separate byte range of the file (see
+        `_copyfile_parallel()`). Parallel file systems often need several streams to reach full bandwidth. If `None`
+        or less than 2, the file is copied with one stream.
+    :param digest: A hash object (see `hashlib`) to update with all copied bytes, or `None`. The bytes are hashed as
+        they are copied, so the source is not read again to compute its checksum. Kernel copy methods are not tried
+        because data must pass through user space to be hashed. Cannot be used with `parallel`.
+    :param offset: Resume a partial copy from this offset. `dst` must exist and be at least this long. It is truncated
+        to `offset`, and only the rest of `src` is copied. If `digest` is set, bytes of `src` before `offset` are read
+        and hashed first, so the digest covers the whole file.
+    :param compress: Compress `dst` to this format (see `COMPRESS_FORMATS`) while copying, or `None`. The file is copied
+        in user space, and `digest` covers the uncompressed data. Cannot be used with `parallel` or `offset`.
+    :param metrics: A `metrics.Metrics` object to report a "copyfile" event to, or `None`. The event has the number of
+        bytes read from `src`, the method, and the time this thread slept waiting for the bandwidth limit.
+
+    :return: Name of the method that copied the data: "reflink", "copy_file_range", "sendfile", "pipeline",
+        "parallel", or "userspace".
     """
 
     # Base code from Python 2.7 (commit 102514:65eb8d0ede75)
 
+    # Copy and report
+    if metrics is not None:
+        governor = _get_governor(bandwidth)
+        sleep_start = governor.get_thread_sleep_time() if governor is not None else 0.0
+
+        with metrics.timer('copyfile', src=src, dst=dst) as fields:
+            fields['method'] = copyfile(src, dst, governor, fast, pipeline, parallel, digest, offset, compress)
+            fields['bytes'] = os.path.getsize(src) - offset
+
+            if governor is not None:
+                fields['sleep_time'] = governor.get_thread_sleep_time() - sleep_start
+
+        return fields['method']
+
     if _samefile(src, dst):
         raise shutil.Error("`%s` and `%s` are the same file" % (src, dst))
 
@@ -283,9 +1782,69 @@ def copyfile(src, dst, bandwidth=None):
             if stat.S_ISFIFO(st.st_mode):
                 raise shutil.SpecialFileError("`%s` is a named pipe" % fn)
 
+    # Check resume offset
+    if offset < 0:
+        raise ValueError('Copy offset must not be negative: {}'.format(offset))
+
+    if compress is not None and (offset > 0 or (parallel is not None and parallel > 1)):
+        raise ValueError('Cannot compress a parallel or resumed copy')
+
+    if offset > 0:
+        for fn in [src, dst]:
+            if os.path.getsize(fn) < offset:
+                raise ValueError('Cannot resume copy at offset {}: File is shorter: {}'.format(offset, fn))
+
+    if parallel is not None and parallel > 1:
+
+        if digest is not None:
+            raise ValueError('Cannot compute a digest in a parallel copy: Ranges are not copied in order')
+
+        with open(src, 'rb') as fsrc:
+            with open(dst, 'r+b' if offset > 0 else 'w+b') as fdst:
+                _copyfile_parallel(fsrc.fileno(), fdst.fileno(), parallel, bandwidth, offset)
+
+        return 'parallel'
+
     with open(src, 'rb') as fsrc:
-        with open(dst, 'wb') as fdst:
-            copyfileobj(fsrc, fdst, bandwidth=bandwidth)
+        with open(dst, 'r+b' if offset > 0 else 'wb') as fdst:
+
+            # Position files to resume
+            if offset > 0:
+                fdst.truncate(offset)
+                fdst.seek(offset)
+
+                if digest is not None:
+                    while fsrc.tell() < offset:
+                        buf = fsrc.read(min(1024*1024, offset - fsrc.tell()))
+
+                        if not buf:
+                            raise IOError(errno.EIO, 'Source file was truncated during copy: {}'.format(src))
+
+                        digest.update(buf)
+                else:
+                    fsrc.seek(offset)
+
+            # Compress
+            if compress is not None:
+                copyfileobj(fsrc, fdst, bandwidth=bandwidth, digest=digest, compress=compress)
+                return 'userspace'
+
+            # Copy with reader thread
+            if pipeline:
+                _copyfileobj_pipelined(fsrc, fdst, bandwidth=bandwidth, digest=digest)
+                return 'pipeline'
+
+            # Copy in kernel
+            if fast and bandwidth is None and digest is None:
+                method = _copyfile_kernel(fsrc, fdst, offset)[0]
+
+                if method is not None:
+                    return method
+
+            # Copy in user space
+            copyfileobj(fsrc, fdst, bandwidth=bandwidth, adaptive=True, digest=digest)
+
+    return 'userspace'
 
 
 def copymode(src, dst):
@@ -315,7 +1874,8 @@ def copy(src, dst, bandwidth=None):
 
     :param src: Source file
     :param dst: Destination file or directory.
-    :param bandwidth: Limit bandwidth or `None` to copy at full speed.
+    :param bandwidth: Limit bandwidth or `None` to copy at full speed. May be a `BandwidthGovernor` to share a limit
+        with other copies.
     """
 
     if os.path.isdir(dst):
@@ -0,0 +1,326 @@
+"""
+Metrics for file transfers: event callbacks, counters, latency histograms, and a JSON-lines trace.
+
+Functions and classes that accept a `metrics` argument report events to a `Metrics` object. If the argument is `None`,
+nothing is measured.
+"""
+
+import collections
+import json
+import math
+import threading
+import time
+
+
+# Upper bound of the first histogram bucket in seconds. Each following bucket is twice as wide.
+_HISTOGRAM_MIN = 1e-6
+
+# Number of histogram buckets. The last bucket holds all values above about 73 hours.
+_HISTOGRAM_BUCKETS = 40
+
+# Quantiles reported by `Histogram.to_dict()`
+_HISTOGRAM_QUANTILES = (0.5, 0.9, 0.99)
+
+
+class Histogram:
+    """
+    A histogram of durations in buckets that double in width, so the relative error of quantiles is the same from
+    microseconds to hours, and the memory used is constant.
+    """
+
+    def __init__(self):
+        """
+        Create a new `Histogram` object.
+        """
+
+        self.bucket_count = [0] * _HISTOGRAM_BUCKETS
+
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        """
+        Add a value.
+
+        :param value: Duration in seconds.
+        """
+
+        if value <= _HISTOGRAM_MIN:
+            index = 0
+        else:
+            index = min(int(math.ceil(math.log2(value / _HISTOGRAM_MIN))), _HISTOGRAM_BUCKETS - 1)
+
+        self.bucket_count[index] += 1
+
+        self.count += 1
+        self.total += value
+
+        if self.min is None or value < self.min:
+            self.min = value
+
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        """
+        Get an approximate quantile.
+
+        :param q: Quantile between 0 and 1.
+
+        :return: Upper bound of the bucket holding the quantile, limited to the range of added values, or `None` if no
+            values were added.
+        """
+
+        if self.count == 0:
+            return None
+
+        rank = q * self.count
+        cumulative = 0
+
+        for index, count in enumerate(self.bucket_count):
+            cumulative += count
+
+            if count > 0 and cumulative >= rank:
+                return min(max(_HISTOGRAM_MIN * 2 ** index, self.min), self.max)
+
+        return self.max
+
+    def to_dict(self):
+        """
+        Summarize the histogram.
+
+        :return: A dictionary with the count, total, mean, minimum, and maximum, and quantiles keyed "p50", "p90", and
+            "p99".
+        """
+
+        summary = {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.total / self.count if self.count > 0 else None,
+            'min': self.min,
+            'max': self.max,
+        }
+
+        for q in _HISTOGRAM_QUANTILES:
+            summary['p{:g}'.format(q * 100)] = self.quantile(q)
+
+        return summary
+
+    def __repr__(self):
+        return '[Histogram: count={}, total={:.6f}]'.format(self.count, self.total)
+
+
+class Metrics:
+    """
+    Collect events reported by file operations.
+
+    An event has a name, such as "copyfile", and fields. For each event, the count of events with the name and the sum
+    of each numeric field are kept as counters named "<event>.count" and "<event>.<field>", and its "duration" is added
+    to the histogram of the event. Each callback is called with the event name and a dictionary of its fields, and the
+    event is appended to the trace file as a line of JSON if one is set.
+
+    Events reported by eeepy:
+
+    * copyfile: `fileutil.copyfile()` copied a file (bytes, method, sleep_time waiting for the bandwidth limit).
+    * writeback: `TempCache` wrote a file back, including retries and validation (bytes written to the destination by
+      the last try, which are compressed bytes for a compressed copy and changed blocks for a delta update, tries,
+      result).
+    * retry: A `TempCache` copy attempt failed and is retried (attempt, offset the retry resumes from, error).
+    * validate: `TempCache` validated a copy (level).
+    * publish: `TempCache` renamed copied files to their destinations (files).
+    * remove: `TempCache` removed a temporary file (tries).
+
+    Events that end with an exception have an "error" field with the exception type.
+    """
+
+    def __init__(self, trace_file=None, callback=None):
+        """
+        Create a new `Metrics` object.
+
+        :param trace_file: Append events to this file as JSON lines, or `None` for no trace.
+        :param callback: A function called with the event name and a dictionary of fields for each event, or `None`.
+            More callbacks may be added with `add_callback()`.
+        """
+
+        self.trace_file = trace_file
+
+        self.__callback_list = [callback] if callback is not None else list()
+        self.__counter = collections.defaultdict(int)
+        self.__histogram = dict()
+        self.__lock = threading.Lock()
+
+        self.__trace = open(trace_file, 'a') if trace_file is not None else None
+
+    def add_callback(self, callback):
+        """
+        Add a function called for each event.
+
+        :param callback: A function called with the event name and a dictionary of fields.
+        """
+
+        self.__callback_list.append(callback)
+
+    def event(self, name, duration=None, **fields):
+        """
+        Report an event.
+
+        :param name: Event name.
+        :param duration: Duration of the event in seconds or `None`.
+        :param fields: Event fields. Values must be serializable as JSON if there is a trace file.
+        """
+
+        if duration is not None:
+            fields['duration'] = duration
+
+        with self.__lock:
+            self.__counter[name + '.count'] += 1
+
+            for field, value in fields.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    self.__counter[name + '.' + field] += value
+
+            if duration is not None:
+                if name not in self.__histogram:
+                    self.__histogram[name] = Histogram()
+
+                self.__histogram[name].add(duration)
+
+            if self.__trace is not None:
+                record = dict(fields)
+                record['event'] = name
+                record['time'] = time.time()
+
+                self.__trace.write(json.dumps(record, sort_keys=True, default=str) + '\n')
+                self.__trace.flush()
+
+        for callback in self.__callback_list:
+            callback(name, fields)
+
+    def timer(self, name, **fields):
+        """
+        Time a block of code and report it as an event when the block exits.
+
+        :param name: Event name.
+        :param fields: Event fields.
+
+        :return: A context manager. Its value is the dictionary of fields, so fields known only at the end of the block
+            can be added to it.
+        """
+
+        return _Timer(self, name, fields)
+
+    def get_counters(self):
+        """
+        Get counters.
+
+        :return: A dictionary of counter values keyed by "<event>.count" and "<event>.<field>".
+        """
+
+        with self.__lock:
+            return dict(self.__counter)
+
+    def get_histogram(self, name):
+        """
+        Get the duration histogram of an event.
+
+        :param name: Event name.
+
+        :return: A `Histogram` or `None` if no event with a duration was reported.
+        """
+
+        return self.__histogram.get(name)
+
+    def summary(self):
+        """
+        Summarize all events.
+
+        :return: A dictionary with "counters" (see `get_counters()`) and "histograms", a dictionary of histogram
+            summaries (see `Histogram.to_dict()`) keyed by event name.
+        """
+
+        with self.__lock:
+            return {
+                'counters': dict(self.__counter),
+                'histograms': {name: histogram.to_dict() for name, histogram in self.__histogram.items()},
+            }
+
+    def close(self):
+        """
+        Close the trace file.
+        """
+
+        with self.__lock:
+            if self.__trace is not None:
+                self.__trace.close()
+                self.__trace = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, ex_type, ex_value, ex_tb):
+        self.close()
+
+        return False
+
+    def __repr__(self):
+        return '[Metrics: trace_file={}, events={}]'.format(
+            self.trace_file, int(sum(value for key, value in self.get_counters().items() if key.endswith('.count')))
+        )
+
+
+class _Timer:
+    """
+    Context manager returned by `Metrics.timer()`.
+    """
+
+    def __init__(self, metrics, name, fields):
+        self.metrics = metrics
+        self.name = name
+        self.fields = fields
+        self.start_time = None
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+
+        return self.fields
+
+    def __exit__(self, ex_type, ex_value, ex_tb):
+
+        if ex_type is not None:
+            self.fields['error'] = ex_type.__name__
+
+        self.metrics.event(self.name, time.perf_counter() - self.start_time, **self.fields)
+
+        return False
+
+
+class _NullTimer:
+    """
+    Context manager returned by `timed()` if metrics are not collected.
+    """
+
+    def __enter__(self):
+        return dict()
+
+    def __exit__(self, ex_type, ex_value, ex_tb):
+        return False
+
+
+def timed(metrics, name, **fields):
+    """
+    Time a block of code if metrics are collected.
+
+    :param metrics: A `Metrics` object or `None`.
+    :param name: Event name.
+    :param fields: Event fields.
+
+    :return: `metrics.timer(name, **fields)`, or a context manager that does nothing if `metrics` is `None`. Its value
+        is a dictionary that fields may be added to in both cases.
+    """
+
+    if metrics is None:
+        return _NullTimer()
+
+    return metrics.timer(name, **fields)
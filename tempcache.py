@@ -1,8 +1,57 @@
 import os
 import uuid
 import time
+import errno
+import json
+import re
 from eeepy import fileutil
+from eeepy import metrics
 import hashlib
+import lzma
+import mmap
+import zlib
+import collections
+import concurrent.futures
+import sqlite3
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# Validation levels from the least to the most thorough
+VALIDATE_LEVELS = ('none', 'size', 'sampled', 'full')
+
+# Checksum algorithms provided by zlib. All algorithms in `hashlib` are also supported.
+ZLIB_ALGORITHMS = ('crc32', 'adler32')
+
+# Buffer length for reading files to checksum
+_CHECKSUM_BUFFER_LENGTH = 1024 * 1024
+
+# Local files at least this large are checksummed through a memory map, which is read in blocks of this length
+_CHECKSUM_MMAP_MIN = 64 * 1024 ** 2
+_CHECKSUM_MMAP_BLOCK = 8 * 1024 ** 2
+
+# Number and length of the blocks compared by sampled validation
+_SAMPLE_COUNT = 16
+_SAMPLE_LENGTH = 64 * 1024
+
+# Length of the blocks compared to find where a failed copy can be resumed
+_RESUME_BLOCK_LENGTH = 4 * 1024 ** 2
+
+# Policies for choosing one of several temporary directories
+PLACEMENT_POLICIES = ('space', 'round_robin', 'size')
+
+# Free space of temporary directories is checked again after this number of seconds
+_FREE_SPACE_TTL = 5.0
+
+# Largest file the "size" placement policy places on tmpfs
+_TMPFS_MAX_FILE = 64 * 1024 ** 2
+
+# Destination files at least this large are updated in place by delta writeback. Smaller files are copied.
+_DELTA_MIN = 64 * 1024 ** 2
 
 
 class ChecksumError(IOError):
@@ -12,68 +61,995 @@ class ChecksumError(IOError):
     pass
 
 
-def _get_checksum(file_name):
+class CorruptDestinationError(IOError):
+    """
+    Raised when updating a destination file in place failed on every try. The destination file was partially rewritten,
+    so it is removed. `dest_file` is the name of the removed file.
+    """
+
+    def __init__(self, dest_file, ex):
+        self.dest_file = dest_file
+
+        super().__init__(
+            'Destination file was partially updated in place and was removed: {}: {}'.format(dest_file, ex)
+        )
+
+
+class WritebackError(IOError):
+    """
+    Raised when one or more files could not be written back by concurrent writeback. `errors` is a list of
+    `(temp_file, dest_file, exception)` tuples, one for each file that failed.
+    """
+
+    def __init__(self, errors):
+        self.errors = list(errors)
+
+        super().__init__('{} file(s) could not be written back: {}'.format(
+            len(self.errors),
+            '; '.join('{}: {}'.format(dest_file, ex) for temp_file, dest_file, ex in self.errors)
+        ))
+
+
+class _ZlibChecksum:
     """
-    Get the MD5 checksum of a file.
+    A hash object computing a zlib CRC-32 or Adler-32 checksum with the same interface as `hashlib` hash objects. These
+    checksums are much faster than cryptographic hashes and detect transfer errors, but they do not protect against
+    deliberate modification.
+    """
+
+    def __init__(self, name, value=None):
+        """
+        Create a new checksum.
+
+        :param name: "crc32" or "adler32".
+        :param value: Initial value or `None` to start a new checksum.
+        """
+
+        if name not in ZLIB_ALGORITHMS:
+            raise ValueError('Unknown zlib checksum algorithm: {}'.format(name))
+
+        self.name = name
+        self.digest_size = 4
+
+        self.__func = zlib.crc32 if name == 'crc32' else zlib.adler32
+        self.__value = value if value is not None else self.__func(b'')
+
+    def update(self, data):
+        self.__value = self.__func(data, self.__value)
+
+    def digest(self):
+        return self.__value.to_bytes(4, 'big')
+
+    def hexdigest(self):
+        return '{:08x}'.format(self.__value)
+
+    def copy(self):
+        return _ZlibChecksum(self.name, self.__value)
+
+
+def _new_hash(algorithm='md5'):
+    """
+    Create a new hash object.
+
+    :param algorithm: Name of a `hashlib` algorithm (e.g. "md5", "sha256", or "blake2b") or a zlib checksum ("crc32" or
+        "adler32").
+
+    :return: A hash object.
+    """
+
+    if algorithm in ZLIB_ALGORITHMS:
+        return _ZlibChecksum(algorithm)
+
+    return hashlib.new(algorithm)
+
+
+def _get_file_identity(stat_result):
+    """
+    Get the identity of a file for caching its checksum.
+
+    :param stat_result: Result of `os.stat()` on the file.
+
+    :return: A tuple of a file ID string (device and inode) and a tuple of size and modification time in nanoseconds.
+    """
+
+    return (
+        '{}:{}'.format(stat_result.st_dev, stat_result.st_ino),
+        (stat_result.st_size, stat_result.st_mtime_ns)
+    )
+
+
+class ChecksumCache:
+    """
+    A cache of file checksums keyed by file identity: device, inode, size, and modification time. A checksum is reused
+    only while all of these are unchanged, so validating an unchanged file again does not read it.
+
+    Checksums are kept in memory, and the least recently used entries are evicted when the cache is full. If a database
+    file is given, checksums are also saved to it (SQLite) and are available to later processes.
+    """
+
+    def __init__(self, max_entries=65536, db_file=None):
+        """
+        Create a new `ChecksumCache` object.
+
+        :param max_entries: Maximum number of checksums kept in memory.
+        :param db_file: Name of a database file to save checksums in or `None` to keep them only in memory. The file is
+            created if it does not exist and may be shared by concurrent processes.
+        """
+
+        self.max_entries = int(max_entries)
+        self.db_file = db_file
+
+        if self.max_entries < 1:
+            raise ValueError('Checksum cache size must be positive: {}'.format(self.max_entries))
+
+        self.__entries = collections.OrderedDict()
+        self.__lock = threading.Lock()
+
+        self.__db = None
+
+        if db_file is not None:
+            self.__db = sqlite3.connect(db_file, timeout=60, check_same_thread=False)
+
+            # Entries are only an optimization, so losing recent entries in a crash is acceptable
+            self.__db.execute('PRAGMA synchronous = OFF')
+
+            self.__db.execute(
+                'CREATE TABLE IF NOT EXISTS checksum ('
+                'file_id TEXT, algorithm TEXT, size INTEGER, mtime_ns INTEGER, checksum TEXT, '
+                'PRIMARY KEY (file_id, algorithm))'
+            )
+
+            self.__db.commit()
+
+    def get(self, file_name, algorithm, stat_result=None):
+        """
+        Get a cached checksum.
+
+        :param file_name: Name of the file.
+        :param algorithm: Checksum algorithm.
+        :param stat_result: Result of `os.stat()` on the file or `None` to get it.
+
+        :return: The checksum or `None` if it is not cached for the current state of the file.
+        """
+
+        if stat_result is None:
+            stat_result = os.stat(file_name)
+
+        file_id, file_state = _get_file_identity(stat_result)
+
+        with self.__lock:
+
+            # Check memory
+            entry = self.__entries.get((file_id, algorithm))
+
+            if entry is not None:
+                if entry[0] == file_state:
+                    self.__entries.move_to_end((file_id, algorithm))
+                    return entry[1]
+
+                return None
+
+            # Check database
+            if self.__db is None:
+                return None
+
+            row = self.__db.execute(
+                'SELECT size, mtime_ns, checksum FROM checksum WHERE file_id = ? AND algorithm = ?',
+                (file_id, algorithm)
+            ).fetchone()
+
+            if row is None or tuple(row[:2]) != file_state:
+                return None
+
+            self.__put_memory(file_id, algorithm, file_state, row[2])
+
+            return row[2]
+
+    def put(self, file_name, algorithm, checksum, stat_result=None):
+        """
+        Save a checksum.
+
+        :param file_name: Name of the file.
+        :param algorithm: Checksum algorithm.
+        :param checksum: Checksum of the file.
+        :param stat_result: Result of `os.stat()` on the file when the checksum was computed, or `None` to get it.
+        """
+
+        if stat_result is None:
+            stat_result = os.stat(file_name)
+
+        file_id, file_state = _get_file_identity(stat_result)
+
+        with self.__lock:
+            self.__put_memory(file_id, algorithm, file_state, checksum)
+
+            if self.__db is not None:
+                self.__db.execute(
+                    'INSERT OR REPLACE INTO checksum (file_id, algorithm, size, mtime_ns, checksum) '
+                    'VALUES (?, ?, ?, ?, ?)',
+                    (file_id, algorithm, file_state[0], file_state[1], checksum)
+                )
+
+                self.__db.commit()
+
+    def close(self):
+        """
+        Close the database file. Checksums kept in memory remain available.
+        """
+
+        with self.__lock:
+            if self.__db is not None:
+                self.__db.close()
+                self.__db = None
+
+    def __put_memory(self, file_id, algorithm, file_state, checksum):
+        """
+        Save a checksum in memory and evict the least recently used checksums if the cache is full. The lock must be
+        held.
+        """
+
+        self.__entries[(file_id, algorithm)] = (file_state, checksum)
+        self.__entries.move_to_end((file_id, algorithm))
+
+        while len(self.__entries) > self.max_entries:
+            self.__entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def __repr__(self):
+        return '[ChecksumCache: entries={}, max_entries={}, db_file={}]'.format(
+            len(self.__entries), self.max_entries, self.db_file
+        )
+
+
+def _get_checksum(file_name, algorithm='md5', cache=None, use_mmap=False):
+    """
+    Get the checksum of a file.
+
+    Large files are read through a memory map if `use_mmap` is set. Other files are read with `hashlib.file_digest()`
+    if it is available, or through one reused buffer of `_CHECKSUM_BUFFER_LENGTH` bytes.
 
     :param file_name: File to check.
+    :param algorithm: Checksum algorithm (see `_new_hash()`).
+    :param cache: A `ChecksumCache` to get the checksum from and save it to, or `None`.
+    :param use_mmap: Read large files through a memory map. Set this only for files on local storage: an I/O error or
+        a file truncated while it is mapped raises `SIGBUS`, which kills the process instead of raising an `OSError`.
+
+    :return: Checksum as a hexadecimal string.
+    """
+
+    digest = _new_hash(algorithm)
+
+    with open(file_name, 'rb') as in_file:
+
+        stat_result = os.fstat(in_file.fileno())
+
+        # Check cache
+        if cache is not None:
+            checksum = cache.get(file_name, algorithm, stat_result)
+
+            if checksum is not None:
+                return checksum
+
+        size = stat_result.st_size
+
+        if use_mmap and size >= _CHECKSUM_MMAP_MIN:
+            with mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ) as in_map:
+
+                if hasattr(in_map, 'madvise') and hasattr(mmap, 'MADV_SEQUENTIAL'):
+                    in_map.madvise(mmap.MADV_SEQUENTIAL)
+
+                with memoryview(in_map) as in_view:
+                    for offset in range(0, len(in_view), _CHECKSUM_MMAP_BLOCK):
+                        digest.update(in_view[offset:offset + _CHECKSUM_MMAP_BLOCK])
+
+        elif hasattr(hashlib, 'file_digest') and not isinstance(digest, _ZlibChecksum):
+            digest = hashlib.file_digest(in_file, lambda: digest)
+
+        else:
+            buf_view = memoryview(bytearray(_CHECKSUM_BUFFER_LENGTH))
+
+            while 1:
+                n_bytes = in_file.readinto(buf_view)
+
+                if not n_bytes:
+                    break
+
+                digest.update(buf_view[:n_bytes])
+
+        checksum = digest.hexdigest()
+
+        # Save checksum if the file did not change while it was read
+        if cache is not None:
+            if _get_file_identity(os.fstat(in_file.fileno())) == _get_file_identity(stat_result):
+                cache.put(file_name, algorithm, checksum, stat_result)
+
+    return checksum
+
+
+def _get_checksum_decompressed(file_name, compress, algorithm='md5'):
+    """
+    Get the checksum of the uncompressed content of a compressed file.
+
+    :param file_name: Compressed file.
+    :param compress: Compression format (see `fileutil.COMPRESS_FORMATS`).
+    :param algorithm: Checksum algorithm (see `_new_hash()`).
+
+    :return: Checksum as a hexadecimal string.
+    """
+
+    digest = _new_hash(algorithm)
+
+    buf_view = memoryview(bytearray(_CHECKSUM_BUFFER_LENGTH))
+
+    with fileutil._open_decompressed(file_name, compress) as in_file:
+        while 1:
+            n_bytes = in_file.readinto(buf_view)
+
+            if not n_bytes:
+                break
+
+            digest.update(buf_view[:n_bytes])
+
+    return digest.hexdigest()
+
+
+def _get_validate_level(validate):
+    """
+    Get a validation level.
+
+    :param validate: A level in `VALIDATE_LEVELS`, `True` for "full", or `False` or `None` for "none".
+
+    :return: Validation level.
+    """
+
+    if validate is True:
+        return 'full'
+
+    if validate is False or validate is None:
+        return 'none'
+
+    level = str(validate).lower()
+
+    if level not in VALIDATE_LEVELS:
+        raise ValueError('Unknown validation level: {} (expected one of: {})'.format(
+            validate, ', '.join(VALIDATE_LEVELS)
+        ))
+
+    return level
+
+
+def _compare_sampled(file_name_a, file_name_b, size):
+    """
+    Compare blocks sampled from two files of the same size. The first and last blocks and blocks evenly spaced between
+    them are compared, so a truncated or partially written file is detected without reading all of it.
+
+    :param file_name_a: First file.
+    :param file_name_b: Second file.
+    :param size: Size of both files.
+
+    :return: `True` if all sampled blocks are identical.
+    """
+
+    # Get sample offsets. Small files are compared completely.
+    if size <= _SAMPLE_COUNT * _SAMPLE_LENGTH:
+        offset_list = range(0, size, _SAMPLE_LENGTH)
+    else:
+        step = (size - _SAMPLE_LENGTH) / (_SAMPLE_COUNT - 1)
+        offset_list = [int(step * index) for index in range(_SAMPLE_COUNT)]
+
+    with open(file_name_a, 'rb') as in_file_a:
+        with open(file_name_b, 'rb') as in_file_b:
+            for offset in offset_list:
+                in_file_a.seek(offset)
+                in_file_b.seek(offset)
+
+                if in_file_a.read(_SAMPLE_LENGTH) != in_file_b.read(_SAMPLE_LENGTH):
+                    return False
+
+    return True
+
+
+def _get_resume_offset(temp_file, dest_file, block_sums, block_length=_RESUME_BLOCK_LENGTH):
+    """
+    Get the offset a failed copy can be resumed from. Blocks of the partial destination are compared with blocks of
+    the source by CRC-32 from the start of the files, and the offset of the first block that is missing or differs is
+    returned.
+
+    :param temp_file: Temporary file (source).
+    :param dest_file: Partial destination file.
+    :param block_sums: List of CRC-32 checksums of source blocks. Checksums missing from the list are computed and
+        appended, so the same list can be passed for each retry of a copy, and source blocks are read only once.
+    :param block_length: Block length.
+
+    :return: Offset of the first block that was not verified, or `0` if the destination does not exist.
+    """
+
+    if not os.path.isfile(dest_file):
+        return 0
+
+    size = min(os.path.getsize(temp_file), os.path.getsize(dest_file))
+
+    # A partial last block is only verified if both files end there
+    if size < os.path.getsize(temp_file):
+        size -= size % block_length
+
+    offset = 0
+
+    with open(temp_file, 'rb') as in_file_temp:
+        with open(dest_file, 'rb') as in_file_dest:
+            while offset < size:
+                index = offset // block_length
+
+                if index == len(block_sums):
+                    in_file_temp.seek(offset)
+                    block_sums.append(zlib.crc32(in_file_temp.read(block_length)))
+
+                in_file_dest.seek(offset)
+
+                if zlib.crc32(in_file_dest.read(min(block_length, size - offset))) != block_sums[index]:
+                    break
+
+                offset += block_length
+
+    return min(offset, size)
+
+
+def _get_fs_type(path):
+    """
+    Get the type of the file system a path is on from the longest mount point containing it in "/proc/self/mounts".
+
+    :param path: Path.
+
+    :return: File system type, such as "tmpfs" or "ext4", or `None` if it cannot be determined.
+    """
+
+    path = os.path.realpath(path)
+
+    try:
+        with open('/proc/self/mounts') as in_file:
+            mount_list = [line.split() for line in in_file]
+
+    except EnvironmentError:
+        return None
+
+    fs_type = None
+    mount_length = -1
+
+    for fields in mount_list:
+        if len(fields) < 3:
+            continue
 
-    :return: MD5 checksum.
+        # Spaces and other special characters are escaped as octal numbers
+        mount_point = re.sub(r'\\([0-7]{3})', lambda match: chr(int(match.group(1), 8)), fields[1])
+
+        if (path == mount_point or path.startswith(mount_point.rstrip('/') + '/')) and \
+                len(mount_point) > mount_length:
+            fs_type = fields[2]
+            mount_length = len(mount_point)
+
+    return fs_type
+
+
+def _get_part_file(dest_file):
+    """
+    Get a unique hidden file name next to a destination file. Files are written back to a part file and renamed to the
+    destination when complete, so a destination file is never seen partially written.
+
+    :param dest_file: Destination file.
+
+    :return: Part file name.
+    """
+
+    return os.path.join(
+        os.path.dirname(dest_file), '.{}.{}.part'.format(os.path.basename(dest_file), uuid.uuid4().hex)
+    )
+
+
+def _fsync_path(path):
+    """
+    Flush a file or directory to storage.
+
+    :param path: File or directory.
+    """
+
+    fd = os.open(path, os.O_RDONLY)
+
+    try:
+        os.fsync(fd)
+
+    except OSError as ex:
+        # Some file systems do not support syncing directories
+        if not (ex.errno == errno.EINVAL and os.path.isdir(path)):
+            raise
+
+    finally:
+        os.close(fd)
+
+
+def _remove_quiet(file_name):
+    """
+    Remove a file if it exists, and ignore errors. Used to clean up files that are not needed.
+
+    :param file_name: File to remove.
+    """
+
+    try:
+        os.remove(file_name)
+
+    except OSError:
+        pass
+
+
+class Journal:
     """
+    An append-only journal of files registered with a `TempCache` and the state of their writeback. Each event is
+    appended as one line of JSON with a single write to a file opened with `O_APPEND`, so caches in several processes
+    may share a journal, and a process killed while writing loses at most its last line.
+
+    Events are "register" (a temporary file and its destination), "commit" (the temporary file is complete and
+    writeback started), and "done" (the destination was written and the temporary file removed if it was set to be
+    removed). Files committed but not done are written back by `recover()`.
+    """
+
+    def __init__(self, journal_file):
+        """
+        Create a new `Journal` object.
+
+        :param journal_file: Journal file. Created when the first event is written.
+        """
+
+        self.journal_file = os.path.abspath(journal_file)
+
+    def write(self, event, temp_file, **fields):
+        """
+        Append an event.
+
+        :param event: Event name ("register", "commit", or "done").
+        :param temp_file: Temporary file.
+        :param fields: Other fields of the event.
+        """
+
+        record = dict(fields)
+        record['event'] = event
+        record['temp_file'] = temp_file
+        record['time'] = time.time()
+
+        line = (json.dumps(record, sort_keys=True) + '\n').encode()
+
+        fd = os.open(self.journal_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+        try:
+            os.write(fd, line)
+
+        finally:
+            os.close(fd)
+
+    def pending(self):
+        """
+        Get files that were committed but not written back. Lines that cannot be parsed, such as a line cut short when
+        a process was killed, are ignored.
+
+        :return: A list of `(temp_file, dest_file, do_rm, compress)` tuples in the order files were registered.
+        """
+
+        entry_dict = collections.OrderedDict()
 
-    # Code from Stack Overflow:
-    # http://stackoverflow.com/questions/3431825/generating-an-md5-checksum-of-a-file
+        if not os.path.isfile(self.journal_file):
+            return list()
+
+        with open(self.journal_file, 'rb') as in_file:
+            for line in in_file:
+                try:
+                    record = json.loads(line)
+                    event = record['event']
+                    temp_file = record['temp_file']
+
+                except (ValueError, KeyError, TypeError):
+                    continue
+
+                if event == 'register':
+                    entry_dict[temp_file] = [
+                        record.get('dest_file'), record.get('do_rm', True), record.get('compress'), False
+                    ]
+
+                elif event == 'commit' and temp_file in entry_dict:
+                    entry_dict[temp_file][3] = True
+
+                elif event == 'done':
+                    entry_dict.pop(temp_file, None)
+
+        return [
+            (temp_file, dest_file, do_rm, compress)
+            for temp_file, (dest_file, do_rm, compress, committed) in entry_dict.items()
+            if committed and dest_file is not None
+        ]
+
+    def __repr__(self):
+        return '[Journal: {}]'.format(self.journal_file)
+
+
+def recover(journal_file, stale_age=24*60*60, **cache_args):
+    """
+    Write back files that a `TempCache` committed but did not finish writing back, such as when its process was
+    killed, and remove stale temporary files. Part files left next to destinations by the interrupted writeback are
+    removed. Call this only when no process is using the journal or writing the same destinations.
+
+    :param journal_file: Journal file of the cache (see `TempCache` argument `journal`). Recovery is recorded in the
+        same journal, so it can be recovered again if it is interrupted.
+    :param stale_age: Remove "*.tmp" files in the temporary directory that were not modified for this number of
+        seconds and are not waiting to be written back, or `None` to keep them.
+    :param cache_args: Arguments for the `TempCache` that writes back files, such as `temp_dir`, `retry`, or
+        `validate`. Stale files are searched for in `temp_dir`. Files are written back by `max_workers` threads.
+
+    :return: A list of destination files that were written back. Committed files that no longer exist are skipped.
+
+    :raises WritebackError: If any file could not be written back. Each file is written back independently, so a
+        failure does not stop other files, and stale files are removed before the error is raised. Files that failed
+        stay pending in the journal.
+    """
+
+    journal = Journal(journal_file)
+
+    cache = TempCache(journal=journal, **cache_args)
+
+    # Restore committed files
+    restore_list = list()
+
+    for temp_file, dest_file, do_rm, compress in journal.pending():
+
+        # Remove part files left by the interrupted writeback
+        part_prefix = '.{}.'.format(os.path.basename(dest_file))
+
+        if os.path.isdir(os.path.dirname(dest_file)):
+            for entry in os.scandir(os.path.dirname(dest_file)):
+                if entry.name.startswith(part_prefix) and entry.name.endswith('.part'):
+                    _remove_quiet(entry.path)
+
+        if os.path.isfile(temp_file):
+            cache._restore(temp_file, dest_file, do_rm, compress)
+            restore_list.append((temp_file, dest_file))
+
+        else:
+            journal.write('done', temp_file, missing=True)
+
+    # Write back
+    dest_list = list()
+    error_list = list()
+
+    with concurrent.futures.ThreadPoolExecutor(int(cache_args.get('max_workers', 1))) as executor:
+        future_list = [
+            (temp_file, dest_file, executor.submit(cache._writeback, temp_file))
+            for temp_file, dest_file in restore_list
+        ]
+
+        for temp_file, dest_file, future in future_list:
+            try:
+                future.result()
+                dest_list.append(dest_file)
+
+            except Exception as ex:
+                error_list.append((temp_file, dest_file, ex))
+
+    # Remove stale temporary files. Files that failed are kept for the next recovery.
+    if stale_age is not None:
+        min_mtime = time.time() - stale_age
+        failed_set = {os.path.abspath(temp_file) for temp_file, dest_file, ex in error_list}
+
+        temp_dir = cache_args.get('temp_dir', 'temp')
+
+        for dir_name in (temp_dir if isinstance(temp_dir, (list, tuple)) else [temp_dir]):
+
+            # A temporary directory may not exist if no files were registered in it
+            if not os.path.isdir(dir_name):
+                continue
+
+            for entry in os.scandir(dir_name):
+                if entry.name.endswith('.tmp') and entry.is_file(follow_symlinks=False) and \
+                        entry.stat(follow_symlinks=False).st_mtime < min_mtime and \
+                        os.path.abspath(entry.path) not in failed_set:
+                    _remove_quiet(entry.path)
+
+    if error_list:
+        raise WritebackError(error_list)
+
+    return dest_list
+
+
+class CacheEntry:
+    """
+    An entry for a cached file.
+    """
+
+    def __init__(self, file_path, temp_file, file_name, do_rm=True, compress=None):
+        """
+        Create an entry for a cached file.
+
+        :param file_path: Full path to the file.
+        :param temp_file: Full path to the temporary file.
+        :param file_name: Original file name `register` was called on.
+        :param do_rm: Remove temporary file if `True`.
+        :param compress: Compression format of the destination file (see `fileutil.COMPRESS_FORMATS`) or `None`.
+        """
+
+        self.__file_path = str(file_path)
+        self.__temp_file = str(temp_file)
+        self.__file_name = str(file_name)
+        self.__do_rm = bool(do_rm)
+        self.__compress = str(compress) if compress is not None else None
+
+    def __str__(self):
+        return '{} -> {} [rm={}]'.format(self.__temp_file, self.__file_path, self.__do_rm)
+
+    def __repr__(self):
+        return '[CacheEntry: temp_file={}, file_path={}]'.format(self.__temp_file, self.__file_path)
+
+    def __getattr__(self, name):
+
+        if name == 'file_path':
+            return self.__file_path
+
+        if name == 'temp_file':
+            return self.__temp_file
+
+        if name == 'file_name':
+            return self.__file_name
+
+        if name == 'do_rm':
+            return self.__do_rm
+
+        if name == 'compress':
+            return self.__compress
+
+        return self.__dict__[name]
+
+
+class StageCache:
+    """
+    A node-local cache of input files shared by all processes that use the same stage directory.
+
+    A file is copied into the stage directory once and read from there by later users until the source file changes
+    (size or modification time). Files staged from the same source directory are placed in the same stage directory,
+    so companion files such as indexes stay next to the files they belong to. The total size of staged files is held
+    below a byte budget by removing the least recently used files that are not in use.
+
+    Locks (`fcntl.flock()`) make concurrent use safe: a file is copied by one process while others wait for it, and a
+    process using a staged file holds a shared lock on it so that it is not removed.
+    """
+
+    def __init__(self, stage_dir, max_bytes=None):
+        """
+        Create a new `StageCache` object.
+
+        :param stage_dir: Stage directory. Created if it does not exist.
+        :param max_bytes: Maximum total size of staged files in bytes or `None` for no limit.
+        """
+
+        if fcntl is None:
+            raise NotImplementedError('Staging input files requires fcntl, which is not available')
+
+        self.stage_dir = os.path.abspath(stage_dir)
+        self.max_bytes = int(max_bytes) if max_bytes is not None else None
+
+        os.makedirs(self.stage_dir, exist_ok=True)
+
+    def stage(self, file_name, copy_func):
+        """
+        Get a staged copy of a file, and copy it into the stage directory if it is not already staged.
+
+        :param file_name: Name of the source file.
+        :param copy_func: Function called with the source file and a destination file to copy a file into the stage
+            directory. It must create the destination file atomically (e.g. by renaming a part file), so other
+            processes never see a partial copy.
+
+        :return: A tuple of the staged file name and a file descriptor holding a shared lock on it. The lock keeps the
+            staged file from being removed until the descriptor is closed. If the file cannot be staged within the
+            byte budget, or if an outdated copy is still in use, `None` is returned.
+        """
+
+        file_name = os.path.abspath(file_name)
+        stat_result = os.stat(file_name)
+
+        stamp = '{} {}'.format(stat_result.st_size, stat_result.st_mtime_ns)
+
+        # Get staged file name
+        stage_subdir = os.path.join(
+            self.stage_dir, hashlib.sha1(os.fsencode(os.path.dirname(file_name))).hexdigest()[:16]
+        )
+
+        os.makedirs(stage_subdir, exist_ok=True)
+
+        staged_file = os.path.join(stage_subdir, os.path.basename(file_name))
+
+        lock_fd = os.open(staged_file + '.lock', os.O_RDWR | os.O_CREAT, 0o666)
+
+        try:
+            for count in range(3):
+
+                # Wait for any process copying the file, and use it if it is current
+                fcntl.flock(lock_fd, fcntl.LOCK_SH)
+
+                if StageCache.__is_current(staged_file, stamp):
+                    # Record use for LRU eviction
+                    os.utime(staged_file + '.stamp')
+
+                    return staged_file, lock_fd
+
+                # Get an exclusive lock to copy the file. This fails if another process is using an outdated copy, or
+                # if it started copying the file first.
+                try:
+                    fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+                except OSError:
+                    fcntl.flock(lock_fd, fcntl.LOCK_SH)
+
+                    if StageCache.__is_current(staged_file, stamp):
+                        return staged_file, lock_fd
+
+                    # Outdated copy is in use, read the source file
+                    os.close(lock_fd)
+                    return None
+
+                # Remove outdated copy
+                StageCache.__remove_staged(staged_file)
+
+                # Make room
+                if not self.__reserve(staged_file, stamp, stat_result.st_size):
+                    os.close(lock_fd)
+                    return None
+
+                # Copy
+                try:
+                    copy_func(file_name, staged_file)
+
+                except Exception:
+                    StageCache.__remove_staged(staged_file)
+                    raise
+
+                # Converting the lock to a shared lock at the top of the loop is not atomic, so the staged file is
+                # checked again in case another process removed it in between
+
+            raise IOError('Staged file was removed repeatedly while it was being staged: {}'.format(staged_file))
+
+        except BaseException:
+            try:
+                os.close(lock_fd)
+            except OSError:
+                pass
+
+            raise
+
+    def __reserve(self, staged_file, stamp, size):
+        """
+        Reserve space for a file by writing its stamp, and remove least recently used files that are not in use until
+        the total size of staged files fits in the budget. The lock on `staged_file` must be held.
+
+        :param staged_file: Staged file name.
+        :param stamp: Stamp of the source file ("size mtime_ns").
+        :param size: Size of the file.
+
+        :return: `True` if space was reserved or `False` if files in use leave too little space.
+        """
+
+        global_fd = os.open(os.path.join(self.stage_dir, '.lock'), os.O_RDWR | os.O_CREAT, 0o666)
+
+        try:
+            fcntl.flock(global_fd, fcntl.LOCK_EX)
+
+            if self.max_bytes is not None:
+
+                if size > self.max_bytes:
+                    return False
+
+                # Get staged files as (last use, size, staged file) tuples
+                staged_list = list()
+
+                for stage_subdir in os.scandir(self.stage_dir):
+                    if not stage_subdir.is_dir(follow_symlinks=False):
+                        continue
+
+                    for entry in os.scandir(stage_subdir.path):
+                        if entry.name.endswith('.stamp'):
+                            try:
+                                staged_list.append((
+                                    entry.stat().st_mtime,
+                                    StageCache.__read_stamp_size(entry.path),
+                                    entry.path[:-len('.stamp')]
+                                ))
+
+                            except (OSError, ValueError):
+                                # Stamp was removed or is incomplete
+                                pass
+
+                total_size = sum(staged_size for use_time, staged_size, other_file in staged_list)
+
+                # Evict least recently used files
+                for use_time, staged_size, other_file in sorted(staged_list):
+
+                    if total_size + size <= self.max_bytes:
+                        break
+
+                    if other_file == staged_file:
+                        continue
+
+                    other_fd = os.open(other_file + '.lock', os.O_RDWR | os.O_CREAT, 0o666)
+
+                    try:
+                        fcntl.flock(other_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+                    except OSError:
+                        # File is in use
+                        os.close(other_fd)
+                        continue
+
+                    try:
+                        StageCache.__remove_staged(other_file)
+                        total_size -= staged_size
 
-    hash_md5 = hashlib.md5()
+                    finally:
+                        os.close(other_fd)
 
-    with open(file_name, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_md5.update(chunk)
+                if total_size + size > self.max_bytes:
+                    return False
 
-    return hash_md5.hexdigest()
+            # Write stamp
+            with open(staged_file + '.stamp', 'w') as out_file:
+                out_file.write(stamp)
 
+            return True
 
-class CacheEntry:
-    """
-    An entry for a cached file.
-    """
+        finally:
+            os.close(global_fd)
 
-    def __init__(self, file_path, temp_file, file_name, do_rm=True):
+    @staticmethod
+    def __is_current(staged_file, stamp):
         """
-        Create an entry for a cached file.
+        Determine if a staged file is complete and matches the current source file.
 
-        :param file_path: Full path to the file.
-        :param temp_file: Full path to the temporary file.
-        :param file_name: Original file name `register` was called on.
-        :param do_rm: Remove temporary file if `True`.
+        :param staged_file: Staged file name.
+        :param stamp: Stamp of the source file.
+
+        :return: `True` if the staged file is current.
         """
 
-        self.__file_path = str(file_path)
-        self.__temp_file = str(temp_file)
-        self.__file_name = str(file_name)
-        self.__do_rm = bool(do_rm)
+        try:
+            with open(staged_file + '.stamp', 'r') as in_file:
+                if in_file.read() != stamp:
+                    return False
 
-    def __str__(self):
-        return '{} -> {} [rm={}]'.format(self.__temp_file, self.__file_path, self.__do_rm)
+            return os.path.getsize(staged_file) == int(stamp.split()[0])
 
-    def __repr__(self):
-        return '[CacheEntry: temp_file={}, file_path={}]'.format(self.__temp_file, self.__file_path)
+        except OSError:
+            return False
 
-    def __getattr__(self, name):
+    @staticmethod
+    def __read_stamp_size(stamp_file):
+        """
+        Get the file size recorded in a stamp file.
 
-        if name == 'file_path':
-            return self.__file_path
+        :param stamp_file: Stamp file name.
 
-        if name == 'temp_file':
-            return self.__temp_file
+        :return: Size in bytes.
+        """
 
-        if name == 'file_name':
-            return self.__file_name
+        with open(stamp_file, 'r') as in_file:
+            return int(in_file.read().split()[0])
 
-        if name == 'do_rm':
-            return self.__do_rm
+    @staticmethod
+    def __remove_staged(staged_file):
+        """
+        Remove a staged file and its stamp. Its lock file is kept because other processes may have it open.
 
-        return self.__dict__[name]
+        :param staged_file: Staged file name.
+        """
+
+        for file_name in (staged_file + '.stamp', staged_file):
+            try:
+                os.remove(file_name)
+
+            except FileNotFoundError:
+                pass
 
 
 class TempCache:
@@ -81,48 +1057,169 @@ class TempCache:
     Manage files cached in a temporary location, and reliably write them back to a final storage location.
     """
 
-    def __init__(self, temp_dir='temp', retry=2, retry_delay=4, copy_on_err=False, bandwidth=None, validate=True):
+    def __init__(self, temp_dir='temp', retry=2, retry_delay=4, copy_on_err=False, bandwidth=None, validate=True,
+                 checksum='md5', checksum_cache=None, max_workers=1, max_per_dir=None, stage_dir=None,
+                 stage_limit=None, fsync=False, delta=False, delta_sampled=False, journal=None, placement='space',
+                 metrics=None):
         """
         Create a new `TempCache` object.
 
-        :param temp_dir: Directory where temporary files are located.
+        :param temp_dir: Directory where temporary files are located, or a list of directories to spread temporary files
+            across, such as directories on several local devices (see `placement`).
         :param retry: Number of times to retry copying a file after the first attempt.
         :param retry_delay: Sleep for this value raised to the power of the retry count between attempts. For example,
             the delay for the second retry attempt is `retry_delay ** 2`.
         :param copy_on_err: Attempt to copy files even if an error was encountered within a with/as block.
         :param bandwidth: Limit file copy rate if not None. May be a string ending with multiplier 'b', 'k', 'm', 'g',
-            or 't'. If no muliplier is given or if an integer is used, 'k' is assumed.
-        :param validate: Validate file transfers by computing an MD5 sum on the source and destination.
+            or 't'. If no muliplier is given or if an integer is used, 'k' is assumed. May also be a
+            `fileutil.BandwidthGovernor` to share one limit with other caches and copies. The limit applies to all
+            files copied by this cache together.
+        :param validate: Validate file transfers. May be one of these levels (see `VALIDATE_LEVELS`): "none" does not
+            validate, "size" compares file sizes, "sampled" compares sizes and blocks sampled from both files, and
+            "full" compares checksums. With "full", the source checksum is computed while the file is copied, so only
+            the destination is read again. `True` is "full", and `False` is "none".
+        :param checksum: Checksum algorithm for "full" validation. May be any `hashlib` algorithm, such as "md5",
+            "sha256", or "blake2b", or a zlib checksum, "crc32" or "adler32". zlib checksums are fastest and detect
+            transfer errors, but not deliberate modification.
+        :param checksum_cache: A `ChecksumCache` consulted before any file is read to compute a checksum, and updated
+            with every checksum computed, or `None` to always read files.
+        :param max_workers: Number of files written back concurrently by `do_copy()` and `commit()`. If greater than 1,
+            all files are attempted by `do_copy()`, and failures are raised together as one `WritebackError`. If 1,
+            files are written back in the order they were registered, and the first failure is raised.
+        :param max_per_dir: Maximum number of files written back concurrently to the same destination directory or
+            `None` for no limit.
+        :param stage_dir: Directory where input files are staged by `register_input()` (see `StageCache`). Processes
+            using the same directory share staged files. If `None`, the "stage" directory in `temp_dir` is used.
+        :param stage_limit: Maximum total size of staged input files or `None` for no limit. May be an integer number
+            of bytes or a string ending with multiplier 'b', 'k', 'm', 'g', or 't' as `bandwidth` is.
+        :param fsync: Flush written back files and their directories to storage before and after they are renamed to
+            their destinations, so they survive a crash of the node. `do_copy()` flushes all files first and each
+            directory once.
+        :param delta: Compare files with existing destination files before writing them back. A file is skipped if the
+            destination has the same size and checksum (using `checksum_cache` if set), and the modification time of the
+            destination is updated. A destination of at least 64 MiB is updated in place, and only blocks that differ
+            are written (see `fileutil._copyfile_delta()`). It is compared by checksum first only if both checksums are
+            cached, and is skipped if the update writes nothing. Updated destinations are not published atomically, and
+            a destination that could not be updated is removed (see `CorruptDestinationError`).
+        :param delta_sampled: With `delta`, skip a file if the destination has the same size and sampled blocks instead
+            of the same checksum. Much faster for large files, but a change outside the sampled blocks is not written
+            back.
+        :param journal: Record registered files and the state of their writeback in this journal file, or `Journal`
+            object, so that files can be written back by `recover()` if this process is killed before it finishes. A
+            file is committed when `commit()` or `do_copy()` starts writing it back.
+        :param placement: Policy for choosing one of several temporary directories for each file (see
+            `PLACEMENT_POLICIES`): "space" chooses the directory with the most free space, "round_robin" chooses
+            directories in turn, and "size" places files up to 64 MiB on tmpfs and other files, or files without a
+            size hint (see `register()`), on the other directories, choosing by free space. Free space is checked with
+            `os.statvfs()` at most every few seconds and reduced by the size hint of each file placed.
+        :param metrics: A `metrics.Metrics` object to report copies, retries, validation, and removal of files to, or
+            `None`.
         """
 
-        self.__temp_dir = str(temp_dir)
+        if isinstance(temp_dir, (list, tuple)):
+            self.__temp_dir_list = [str(dir_name) for dir_name in temp_dir]
+        else:
+            self.__temp_dir_list = [str(temp_dir)]
+
+        if not self.__temp_dir_list:
+            raise ValueError('No temporary directory')
+
+        self.__temp_dir = self.__temp_dir_list[0]
 
         self.__registered_file = dict()
         self.__copy_on_err = bool(copy_on_err)
         self.__retry = int(retry)
         self.__retry_delay = int(retry_delay)
-        self.__bandwidth = bandwidth
-        self.__validate = bool(validate)
+        self.__bandwidth = fileutil._get_governor(bandwidth)
+        self.__validate = _get_validate_level(validate)
+        self.__checksum = str(checksum)
+        self.__checksum_cache = checksum_cache
+        self.__max_workers = int(max_workers)
+        self.__max_per_dir = int(max_per_dir) if max_per_dir is not None else None
+        self.__fsync = bool(fsync)
+        self.__delta = bool(delta)
+        self.__delta_sampled = bool(delta_sampled)
+        self.__journal = Journal(journal) if journal is not None and not isinstance(journal, Journal) else journal
+        self.__placement = str(placement)
+        self.__metrics = metrics
+
+        # Temporary directory placement (directory -> (check time, free bytes), directory -> is tmpfs)
+        self.__placement_index = 0
+        self.__free_space = dict()
+        self.__tmpfs = dict()
+        self.__placement_lock = threading.Lock()
+
+        # Semaphores limiting concurrent writeback per destination directory
+        self.__dir_semaphore = dict()
+        self.__dir_semaphore_lock = threading.Lock()
+
+        # Input file staging
+        self.__stage_dir = str(stage_dir) if stage_dir is not None else os.path.join(self.__temp_dir, 'stage')
+
+        # Directories on local storage, with a trailing separator
+        self.__local_dir_list = [
+            os.path.join(os.path.abspath(dir_name), '') for dir_name in self.__temp_dir_list + [self.__stage_dir]
+        ]
+
+        if stage_limit is None or isinstance(stage_limit, int):
+            self.__stage_limit = stage_limit
+        else:
+            self.__stage_limit = fileutil._parse_bandwidth(stage_limit)
+
+        self.__stage_cache = None
+        self.__stage_lock_fd = list()
+
+        # Files committed for writeback in the background (temp file -> future)
+        self.__committed = dict()
+        self.__executor = None
+        self.__commit_lock = threading.Lock()
+
+        # Check algorithm
+        _new_hash(self.__checksum)
 
         if self.__retry < 0:
             raise ValueError('Retry value must not be negative: %d' % self.__retry)
 
-    def register(self, file_name, do_rm=True):
+        if self.__max_workers < 1:
+            raise ValueError('Number of workers must be positive: %d' % self.__max_workers)
+
+        if self.__max_per_dir is not None and self.__max_per_dir < 1:
+            raise ValueError('Number of workers per directory must be positive: %d' % self.__max_per_dir)
+
+        if self.__placement not in PLACEMENT_POLICIES:
+            raise ValueError('Placement policy must be one of {}: {}'.format(
+                ', '.join(PLACEMENT_POLICIES), self.__placement
+            ))
+
+    def register(self, file_name, do_rm=True, size_hint=None, compress=None):
         """
         Register a file that should be cached.
 
         :param file_name: Name of the file that should be cached.
         :param do_rm: Remove temporary file when a with/as block is exited or `do_copy()` is called.
+        :param size_hint: Expected size of the file in bytes or `None` if unknown. Used to choose a temporary directory
+            if there are several (see `placement`).
+        :param compress: Compress the file to this format while it is written back (see `fileutil.COMPRESS_FORMATS`):
+            "gzip", "bgzip" (BGZF blocks that tabix and htslib can index), or "lzma" (xz). The temporary file is not
+            compressed, and `file_name` should have the extension of the format. Validation compares the uncompressed
+            content of the destination with the temporary file, so any level but "none" reads the whole destination.
 
         :return: Absolute path to the temporary file.
         """
 
+        if compress is not None and compress not in fileutil.COMPRESS_FORMATS:
+            raise ValueError('Compression format must be one of {}: {}'.format(
+                ', '.join(fileutil.COMPRESS_FORMATS), compress
+            ))
+
         # Get locations
         file_path = os.path.abspath(file_name)
         base_name = os.path.basename(file_path)
 
+        temp_dir = self.__place(size_hint)
+
         # Create temporary file name
-        temp_file = os.path.join(self.__temp_dir, '{}.{}.tmp'.format(base_name, uuid.uuid1().hex))
+        temp_file = os.path.join(temp_dir, '{}.{}.tmp'.format(base_name, uuid.uuid1().hex))
 
         if os.path.exists(temp_file):
             # Try two more file names
@@ -130,17 +1227,184 @@ class TempCache:
             file_count = 1
 
             while os.path.exists(temp_file) and file_count < 3:
-                temp_file = '%s.%s.tmp' % (base_name, uuid.uuid1().hex)
+                temp_file = os.path.join(temp_dir, '{}.{}.tmp'.format(base_name, uuid.uuid1().hex))
+                file_count += 1
 
             if os.path.exists(temp_file):
                 raise IOError('Cannot resolve a temporary file name for {} after 3 attempts'.format(file_name))
 
         # Save
-        self.__registered_file[temp_file] = CacheEntry(file_path, temp_file, file_name, do_rm)
+        self.__registered_file[temp_file] = CacheEntry(file_path, temp_file, file_name, do_rm, compress)
+
+        if self.__journal is not None:
+            self.__journal.write('register', temp_file, dest_file=file_path, do_rm=bool(do_rm), compress=compress)
 
         # Return temporary file
         return temp_file
 
+    def __place(self, size_hint=None):
+        """
+        Choose a temporary directory for a new file by the placement policy of this cache.
+
+        :param size_hint: Expected size of the file in bytes or `None` if unknown.
+
+        :return: Temporary directory.
+        """
+
+        if len(self.__temp_dir_list) == 1:
+            return self.__temp_dir
+
+        with self.__placement_lock:
+
+            # Round-robin
+            if self.__placement == 'round_robin':
+                temp_dir = self.__temp_dir_list[self.__placement_index % len(self.__temp_dir_list)]
+                self.__placement_index += 1
+
+                return temp_dir
+
+            # Choose small files for tmpfs, and keep other files off tmpfs
+            candidate_list = self.__temp_dir_list
+
+            if self.__placement == 'size':
+                tmpfs_list = list()
+
+                if size_hint is not None and size_hint <= _TMPFS_MAX_FILE:
+                    tmpfs_list = [
+                        dir_name for dir_name in candidate_list
+                        if self.__is_tmpfs(dir_name) and self.__get_free_space(dir_name) >= size_hint
+                    ]
+
+                disk_list = [dir_name for dir_name in candidate_list if not self.__is_tmpfs(dir_name)]
+
+                if tmpfs_list:
+                    candidate_list = tmpfs_list
+
+                elif disk_list:
+                    candidate_list = disk_list
+
+            # Choose by free space
+            if size_hint is not None:
+                fit_list = [dir_name for dir_name in candidate_list if self.__get_free_space(dir_name) >= size_hint]
+
+                if fit_list:
+                    candidate_list = fit_list
+
+            temp_dir = max(candidate_list, key=self.__get_free_space)
+
+            # Reserve space until free space is checked again
+            if size_hint is not None:
+                check_time, free_bytes = self.__free_space[temp_dir]
+                self.__free_space[temp_dir] = (check_time, free_bytes - size_hint)
+
+            return temp_dir
+
+    def __get_free_space(self, dir_name):
+        """
+        Get the free space of a temporary directory. The result of `os.statvfs()` is cached for a few seconds.
+
+        :param dir_name: Temporary directory.
+
+        :return: Free space in bytes available to this process, or 0 if it cannot be determined.
+        """
+
+        check_time, free_bytes = self.__free_space.get(dir_name, (None, None))
+
+        if check_time is None or time.monotonic() - check_time > _FREE_SPACE_TTL:
+            try:
+                stat_result = os.statvfs(dir_name)
+                free_bytes = stat_result.f_bavail * stat_result.f_frsize
+
+            except OSError:
+                free_bytes = 0
+
+            self.__free_space[dir_name] = (time.monotonic(), free_bytes)
+
+        return free_bytes
+
+    def __is_tmpfs(self, dir_name):
+        """
+        Determine if a temporary directory is on tmpfs.
+
+        :param dir_name: Temporary directory.
+
+        :return: `True` if `dir_name` is on tmpfs.
+        """
+
+        if dir_name not in self.__tmpfs:
+            self.__tmpfs[dir_name] = _get_fs_type(dir_name) == 'tmpfs'
+
+        return self.__tmpfs[dir_name]
+
+    def _restore(self, temp_file, file_name, do_rm=True, compress=None):
+        """
+        Register an existing temporary file, such as a file left by another cache (see `recover()`).
+
+        The file is not recorded in the journal again. It is still registered and committed there, so it stays pending
+        until its writeback is done, even if this cache is interrupted before it starts writing it back.
+
+        :param temp_file: Temporary file.
+        :param file_name: Destination file.
+        :param do_rm: Remove temporary file after it is written back.
+        :param compress: Compression format of the destination file or `None` (see `register()`).
+        """
+
+        file_path = os.path.abspath(file_name)
+
+        self.__registered_file[temp_file] = CacheEntry(file_path, temp_file, file_name, do_rm, compress)
+
+    def register_input(self, file_name):
+        """
+        Stage an input file in local temporary storage. The file is copied once with the same retries and validation
+        as writeback, and later registrations of the same unchanged file, in this or other processes using the same
+        stage directory, reuse the copy. The staged file is kept from being removed until this cache exits its with/as
+        block or `release_inputs()` is called.
+
+        :param file_name: Name of the input file.
+
+        :return: Absolute path of the staged file, or of `file_name` itself if it does not fit in the stage limit.
+        """
+
+        file_path = os.path.abspath(file_name)
+
+        with self.__commit_lock:
+            if self.__stage_cache is None:
+                self.__stage_cache = StageCache(self.__stage_dir, self.__stage_limit)
+
+        stage_result = self.__stage_cache.stage(file_path, self.__copy_input)
+
+        if stage_result is None:
+            return file_path
+
+        staged_file, lock_fd = stage_result
+
+        self.__stage_lock_fd.append(lock_fd)
+
+        return staged_file
+
+    def __copy_input(self, file_name, staged_file):
+        """
+        Copy an input file to the stage directory with `_copy_file()` and rename its part file to the staged file name,
+        so the copy is renamed once.
+
+        :param file_name: Input file.
+        :param staged_file: File name in the stage directory.
+        """
+
+        part_file = self._copy_file(file_name, staged_file)
+
+        if part_file is not None:
+            os.replace(part_file, staged_file)
+
+    def release_inputs(self):
+        """
+        Release all input files staged by `register_input()`. Released files may be removed to make room for other
+        staged files.
+        """
+
+        while self.__stage_lock_fd:
+            os.close(self.__stage_lock_fd.pop())
+
     def list_tuples(self):
         """
         Iterate over entries as tuples where the temp file is the first tuple element, and the destination file
@@ -171,81 +1435,435 @@ class TempCache:
         :return: False. Exceptions are never ignored.
         """
 
-        # Copy all files
-        if ex_type is None or self.__copy_on_err:
-            self.do_copy()
+        try:
+            # Copy all files
+            if ex_type is None or self.__copy_on_err:
+                self.do_copy()
+
+            else:
+                # Do not leave files being written after the block exits
+                self.__wait_committed()
+
+        finally:
+            self.release_inputs()
 
         return False
 
+    def commit(self, temp_file):
+        """
+        Start writing back a registered file in the background. Call this when a file is complete to overlap its
+        writeback with other work. `do_copy()` and the end of a with/as block wait for committed files instead of
+        copying them again. Committing a file more than once returns the same future.
+
+        :param temp_file: Temporary file returned by `register()`.
+
+        :return: A `concurrent.futures.Future` that completes when the file is written back. Its result is `None`, and
+            it raises the exception that stopped the writeback if it failed.
+        """
+
+        if temp_file not in self.__registered_file:
+            raise ValueError('Cannot commit file: File is not registered: {}'.format(temp_file))
+
+        with self.__commit_lock:
+            future = self.__committed.get(temp_file)
+
+            if future is None:
+                if self.__journal is not None:
+                    self.__journal.write('commit', temp_file)
+
+                if self.__executor is None:
+                    self.__executor = concurrent.futures.ThreadPoolExecutor(self.__max_workers)
+
+                future = self.__executor.submit(self._writeback, temp_file)
+                self.__committed[temp_file] = future
+
+        return future
+
     def do_copy(self):
         """
         Copy all registered files.
+
+        All files are copied to part files before any is renamed to its destination (see `_publish()`), so files
+        written back together appear together. Files that were copied are published even if others failed.
         """
 
-        # Iterate through all files
-        for temp_file in self.__registered_file:
-            cache_entry = self.__registered_file[temp_file]
+        # Files not committed in the background
+        temp_list = [temp_file for temp_file in self.__registered_file if temp_file not in self.__committed]
+
+        copied_list = list()
+        error_list = list()
 
-            # Copy
-            self._copy_file(temp_file, cache_entry.file_path)
+        if self.__journal is not None:
+            for temp_file in temp_list:
+                self.__journal.write('commit', temp_file)
 
-            # Remove
-            if cache_entry.do_rm:
+        try:
+            if self.__max_workers == 1:
+                # Iterate through all files
+                for temp_file in temp_list:
+                    copied_list.append((temp_file, self._writeback(temp_file, False)))
+
+            else:
+                # Copy concurrently
+                with self.__commit_lock:
+                    if self.__executor is None:
+                        self.__executor = concurrent.futures.ThreadPoolExecutor(self.__max_workers)
+
+                    future_list = [
+                        (temp_file, self.__executor.submit(self._writeback, temp_file, False))
+                        for temp_file in temp_list
+                    ]
+
+                for temp_file, future in future_list:
+                    try:
+                        copied_list.append((temp_file, future.result()))
+
+                    except Exception as ex:
+                        error_list.append((temp_file, self.__registered_file[temp_file].file_path, ex))
+
+        finally:
+            try:
+                self._publish(copied_list)
+
+            finally:
+                error_list = self.__wait_committed() + error_list
+
+        if error_list:
+            if self.__max_workers == 1:
+                raise error_list[0][2]
+
+            raise WritebackError(error_list)
+
+    def __wait_committed(self):
+        """
+        Wait for all files committed in the background.
+
+        :return: A list of `(temp_file, dest_file, exception)` tuples for files that failed.
+        """
+
+        error_list = list()
+
+        with self.__commit_lock:
+            committed_list = list(self.__committed.items())
+            executor = self.__executor
+            self.__executor = None
+
+        for temp_file, future in committed_list:
+            try:
+                future.result()
+
+            except Exception as ex:
+                error_list.append((temp_file, self.__registered_file[temp_file].file_path, ex))
+
+        if executor is not None:
+            executor.shutdown()
+
+        return error_list
+
+    def _writeback(self, temp_file, publish=True):
+        """
+        Copy one registered file to its destination and remove the temporary file if the entry is set to remove it.
+
+        :param temp_file: Temporary file.
+        :param publish: Rename the copy to its destination and remove the temporary file. If `False`, the copy is left
+            in its part file for `_publish()`.
+
+        :return: Part file containing the copy if `publish` is `False`, and `None` otherwise.
+        """
+
+        cache_entry = self.__registered_file[temp_file]
+
+        # Copy
+        dir_semaphore = self.__get_dir_semaphore(cache_entry.file_path)
+
+        if dir_semaphore is not None:
+            with dir_semaphore:
+                part_file = self._copy_file(temp_file, cache_entry.file_path, cache_entry.compress)
+        else:
+            part_file = self._copy_file(temp_file, cache_entry.file_path, cache_entry.compress)
+
+        if not publish:
+            return part_file
+
+        # Rename and remove
+        self._publish([(temp_file, part_file)])
+
+        return None
+
+    def _publish(self, copied_list):
+        """
+        Rename copied files to their destinations and remove temporary files that are set to be removed. If this cache
+        flushes files to storage, all part files are flushed before they are renamed, and each destination directory is
+        flushed once after all renames. Part files that were not renamed are removed.
+
+        :param copied_list: A list of `(temp_file, part_file)` tuples. `part_file` is `None` if the destination was
+            already written (see `_copy_file()`).
+        """
+
+        with metrics.timed(self.__metrics, 'publish', files=len(copied_list)):
+            rename_list = [(temp_file, part_file) for temp_file, part_file in copied_list if part_file is not None]
+
+            published = 0
+
+            try:
+                # Flush files
+                if self.__fsync:
+                    for temp_file, part_file in rename_list:
+                        _fsync_path(part_file)
+
+                # Rename
+                for temp_file, part_file in rename_list:
+                    os.replace(part_file, self.__registered_file[temp_file].file_path)
+                    published += 1
+
+                # Flush directories
+                if self.__fsync:
+                    for dir_name in {os.path.dirname(part_file) for temp_file, part_file in rename_list}:
+                        _fsync_path(dir_name)
+
+            finally:
+                for temp_file, part_file in rename_list[published:]:
+                    _remove_quiet(part_file)
+
+        # Remove
+        for temp_file, part_file in copied_list:
+            if self.__registered_file[temp_file].do_rm:
                 self._rm_file(temp_file)
 
-    def _copy_file(self, temp_file, dest_file):
+            if self.__journal is not None:
+                self.__journal.write('done', temp_file)
+
+    def __get_dir_semaphore(self, dest_file):
+        """
+        Get the semaphore limiting concurrent writeback to the directory of a destination file.
+
+        :param dest_file: Destination file.
+
+        :return: A semaphore or `None` if writeback per directory is not limited.
+        """
+
+        if self.__max_per_dir is None:
+            return None
+
+        dir_name = os.path.dirname(dest_file)
+
+        with self.__dir_semaphore_lock:
+            if dir_name not in self.__dir_semaphore:
+                self.__dir_semaphore[dir_name] = threading.BoundedSemaphore(self.__max_per_dir)
+
+            return self.__dir_semaphore[dir_name]
+
+    def _copy_file(self, temp_file, dest_file, compress=None):
         """
-        Copy a temporary file to a destination file. Retry copy if it fails.
+        Copy a temporary file next to a destination file and validate it. Retry copy if it fails.
+
+        The copy is written to a hidden part file in the destination directory (see `_get_part_file()`), which the
+        caller renames to `dest_file`. A retry resumes from the first block of the partial copy that does not match the
+        temporary file (see `_get_resume_offset()`), so data that was already copied is not copied again.
 
-        :param temp_file:
-        :param dest_file:
-        :return:
+        With delta writeback, an existing destination file that is identical is not copied, and a large destination
+        file is updated in place. Compressed copies are not compared with the destination, and a retry starts again
+        from the beginning.
+
+        :param temp_file: Temporary file (source).
+        :param dest_file: Destination file.
+        :param compress: Compress the copy to this format (see `fileutil.COMPRESS_FORMATS`) or `None`.
+
+        :return: Part file containing the validated copy, or `None` if `dest_file` was skipped or updated in place.
         """
 
-        # Check file
-        if not os.path.isfile(temp_file):
-            raise IOError('Cannot copy temp file: File does not exist: {}'.format(temp_file))
+        with metrics.timed(self.__metrics, 'writeback', src=temp_file, dst=dest_file, compress=compress) as fields:
+
+            # Check file
+            if not os.path.isfile(temp_file):
+                raise IOError('Cannot copy temp file: File does not exist: {}'.format(temp_file))
+
+            # Compare with destination
+            in_place = False
 
-        # Initialize
-        n_try = 0
-        last_ex = None
+            if self.__delta and compress is None and os.path.isfile(dest_file):
+                in_place = os.path.getsize(dest_file) >= _DELTA_MIN
 
-        while n_try <= self.__retry:
+                # A file updated in place is compared while it is updated, so it is compared first only if that is
+                # cheap, and an update that writes nothing is a skip
+                if self.__is_identical(temp_file, dest_file, in_place):
+                    self.__skip(temp_file, dest_file)
+
+                    fields['result'] = 'skipped'
+                    return None
+
+            # Initialize
+            n_try = 0
             last_ex = None
+            block_sums = list()
 
-            # Sleep between retries to allow a file system to recover
-            if n_try > 0:
-                time.sleep(int(self.__retry_delay ** n_try))
+            part_file = _get_part_file(dest_file) if not in_place else None
+            copy_file = part_file if not in_place else dest_file
 
-            # Copy
-            try:
-                fileutil.copyfile(temp_file, dest_file, bandwidth=self.__bandwidth)
+            while n_try <= self.__retry:
+                offset = 0
 
-            except Exception as ex:
-                last_ex = ex
+                # Sleep between retries to allow a file system to recover, and find where to resume. An update in place
+                # compares all blocks again, so it resumes without an offset.
+                if n_try > 0:
+                    time.sleep(int(self.__retry_delay ** n_try))
 
-            # Validate
-            self._validate_copy(temp_file, dest_file)
+                    if not in_place and compress is None:
+                        try:
+                            offset = _get_resume_offset(temp_file, part_file, block_sums)
 
-            # Increment the number of tries
-            n_try += 1
+                        except EnvironmentError:
+                            offset = 0
 
-        # Raise the last exception
-        if last_ex is not None:
+                    if self.__metrics is not None:
+                        self.__metrics.event(
+                            'retry', file=dest_file, attempt=n_try, offset=offset, error=repr(last_ex)
+                        )
 
-            # Remove destination path
-            if os.path.exists(dest_file):
-                for count in range(3):
-                    try:
-                        os.remove(dest_file)
-                        break
+                last_ex = None
+
+                # Hash source while copying. The uncompressed content of compressed copies is always compared by
+                # checksum.
+                if self.__validate == 'full' or (compress is not None and self.__validate != 'none'):
+                    digest = _new_hash(self.__checksum)
+                else:
+                    digest = None
+
+                # Copy and validate
+                try:
+                    if in_place:
+                        same_size = os.path.getsize(temp_file) == os.path.getsize(dest_file)
 
-                    except Exception:
-                        time.sleep(5)  # Wait 5 seconds and try again
+                        # The cached checksum of the destination stays valid if nothing is written
+                        if self.__checksum_cache is not None and digest is None:
+                            cksum_dest = self.__checksum_cache.get(dest_file, self.__checksum)
+                        else:
+                            cksum_dest = None
+
+                        bytes_written = fileutil._copyfile_delta(
+                            temp_file, dest_file, bandwidth=self.__bandwidth, digest=digest
+                        )
+
+                        if same_size and bytes_written == 0:
+                            self.__skip(
+                                temp_file, dest_file, digest.hexdigest() if digest is not None else cksum_dest
+                            )
+
+                            fields['result'] = 'skipped'
+                            fields['tries'] = n_try + 1
+
+                            return None
+
+                    else:
+                        fileutil.copyfile(
+                            temp_file, part_file, bandwidth=self.__bandwidth, digest=digest, offset=offset,
+                            compress=compress, metrics=self.__metrics
+                        )
+
+                        bytes_written = os.path.getsize(part_file) - offset
+
+                    self._validate_copy(
+                        temp_file, copy_file, digest.hexdigest() if digest is not None else None, compress
+                    )
+
+                    if in_place and self.__fsync:
+                        _fsync_path(dest_file)
+
+                    fields['result'] = 'delta' if in_place else 'copied'
+                    fields['bytes'] = bytes_written
+                    fields['tries'] = n_try + 1
+
+                    return part_file
+
+                except Exception as ex:
+                    last_ex = ex
+
+                # Increment the number of tries
+                n_try += 1
+
+            # Remove part file and raise the last exception. The destination file was not modified unless it was updated
+            # in place, and a destination that was partially updated is removed.
+            if part_file is not None:
+                _remove_quiet(part_file)
+
+            if in_place:
+                _remove_quiet(dest_file)
+                raise CorruptDestinationError(dest_file, last_ex) from last_ex
 
-            # Rethrow
             raise last_ex
 
+    def __is_identical(self, temp_file, dest_file, cached_only=False):
+        """
+        Determine if a destination file already matches a temporary file. Files are compared by size, then by checksum,
+        or by sampled blocks if `delta_sampled` is set.
+
+        :param temp_file: Temporary file.
+        :param dest_file: Destination file.
+        :param cached_only: Compare checksums only if both are in the checksum cache, and do not read the files to get
+            them.
+
+        :return: `True` if the files match, and `False` if they differ or were not compared.
+        """
+
+        size_temp = os.path.getsize(temp_file)
+
+        if size_temp != os.path.getsize(dest_file):
+            return False
+
+        if self.__delta_sampled:
+            return _compare_sampled(temp_file, dest_file, size_temp)
+
+        if cached_only:
+            if self.__checksum_cache is None:
+                return False
+
+            cksum_temp = self.__checksum_cache.get(temp_file, self.__checksum)
+
+            return cksum_temp is not None and cksum_temp == self.__checksum_cache.get(dest_file, self.__checksum)
+
+        return self.__get_checksum(temp_file) == self.__get_checksum(dest_file)
+
+    def __get_checksum(self, file_name):
+        """
+        Get the checksum of a file with the algorithm and checksum cache of this cache. Files in the temporary and
+        stage directories are read through a memory map, and other files, such as destinations or input files on
+        network storage, are read through a buffer (see `_get_checksum()`).
+
+        :param file_name: File to check.
+
+        :return: Checksum as a hexadecimal string.
+        """
+
+        file_path = os.path.abspath(file_name)
+
+        return _get_checksum(
+            file_name, self.__checksum, self.__checksum_cache,
+            any(file_path.startswith(dir_name) for dir_name in self.__local_dir_list)
+        )
+
+    def __skip(self, temp_file, dest_file, checksum=None):
+        """
+        Keep a destination file that already matches a temporary file. The destination is made newer than the files it
+        was made from, as a newly written file would be, so that workflow tools do not consider it outdated, and its
+        cached checksum is saved for the new modification time.
+
+        :param temp_file: Temporary file.
+        :param dest_file: Destination file.
+        :param checksum: Checksum of the files or `None` to get it from the checksum cache if it was compared by
+            checksum.
+        """
+
+        os.utime(dest_file)
+
+        if self.__checksum_cache is None:
+            return
+
+        if checksum is None and not self.__delta_sampled:
+            checksum = self.__checksum_cache.get(temp_file, self.__checksum)
+
+        if checksum is not None:
+            self.__checksum_cache.put(dest_file, self.__checksum, checksum)
+
     def _rm_file(self, file):
         """
         Remove file.
@@ -253,54 +1871,113 @@ class TempCache:
         :param file: File to be removed.
         """
 
-        # Check file
-        if not os.path.isfile(file):
-            raise IOError('Cannot remove file: File does not exist: {}'.format(file))
+        with metrics.timed(self.__metrics, 'remove', file=file) as fields:
 
-        # Initialize
-        n_try = 0
-        last_ex = None
+            # Check file
+            if not os.path.isfile(file):
+                raise IOError('Cannot remove file: File does not exist: {}'.format(file))
 
-        while n_try <= self.__retry:
+            # Initialize
+            n_try = 0
+            last_ex = None
 
-            # Sleep between retries to allow a file system to recover
-            if n_try > 0:
-                time.sleep(int(self.__retry_delay ** n_try))
+            while n_try <= self.__retry:
 
-            # Remove file
-            try:
-                os.remove(file)
-                break
+                # Sleep between retries to allow a file system to recover
+                if n_try > 0:
+                    time.sleep(int(self.__retry_delay ** n_try))
 
-            except EnvironmentError as ex:
-                last_ex = ex
+                # Remove file
+                try:
+                    os.remove(file)
+                    fields['tries'] = n_try + 1
+                    break
 
-            # Increment the number of tries
-            n_try += 1
+                except EnvironmentError as ex:
+                    last_ex = ex
 
-        # Raise the last exception
-        if last_ex is not None:
-            raise last_ex
+                # Increment the number of tries
+                n_try += 1
 
-    def _validate_copy(self, temp_file, dest_file):
+            # Raise the last exception
+            if last_ex is not None:
+                raise last_ex
+
+    def _validate_copy(self, temp_file, dest_file, cksum_temp=None, compress=None):
         """
-        Validate the copy operation.
+        Validate the copy operation at the validation level of this cache.
+
+        :param temp_file: Temporary file (source).
+        :param dest_file: Destination file.
+        :param cksum_temp: Checksum of the temporary file computed while it was copied, or `None` to compute it from the
+            file if it is needed.
+        :param compress: Compression format of `dest_file` or `None`. The uncompressed content is compared with the
+            temporary file by checksum at all validation levels except "none".
+
+        :raises ChecksumError: If the destination does not match the temporary file.
         """
-        # TODO: Complete and document this method
 
-        # Do not validate if disabled
-        if not self.__validate:
-            return
+        with metrics.timed(self.__metrics, 'validate', file=dest_file, level=self.__validate):
+
+            # Do not validate if disabled
+            if self.__validate == 'none':
+                return
+
+            # Compare uncompressed content
+            if compress is not None:
+                if cksum_temp is None:
+                    cksum_temp = self.__get_checksum(temp_file)
+
+                try:
+                    cksum_dest = _get_checksum_decompressed(dest_file, compress, self.__checksum)
+
+                except (EOFError, ValueError, OSError, zlib.error, lzma.LZMAError) as ex:
+                    raise ChecksumError('Destination file cannot be decompressed: {}: {}'.format(dest_file, ex))
+
+                if cksum_temp != cksum_dest:
+                    raise ChecksumError(
+                        'Temporary file and uncompressed destination file checksum mismatch: '
+                        'Source=0x{}, Destination=0x{}'
+                        .format(cksum_temp, cksum_dest)
+                    )
+
+                return
 
-        # Get checksums and compare
-        cksum_temp = _get_checksum(temp_file)
-        cksum_dest = _get_checksum(dest_file)
+            # Compare sizes
+            size_temp = os.path.getsize(temp_file)
+            size_dest = os.path.getsize(dest_file)
 
-        if cksum_temp != cksum_dest:
-            raise ChecksumError('Temporary file and destination file checksum mismatch: Source=0x{}, Destination=0x{}'
-                                .format(cksum_temp, cksum_dest))
+            if size_temp != size_dest:
+                raise ChecksumError('Temporary file and destination file size mismatch: Source={}, Destination={}'
+                                    .format(size_temp, size_dest))
 
-        return
+            if self.__validate == 'size':
+                return
+
+            # Compare sampled blocks
+            if self.__validate == 'sampled':
+                if not _compare_sampled(temp_file, dest_file, size_temp):
+                    raise ChecksumError('Temporary file and destination file differ in sampled blocks: {} -> {}'
+                                        .format(temp_file, dest_file))
+
+                return
+
+            # Get checksums and compare
+            if cksum_temp is None:
+                cksum_temp = self.__get_checksum(temp_file)
+
+            elif self.__checksum_cache is not None:
+                self.__checksum_cache.put(temp_file, self.__checksum, cksum_temp)
+
+            cksum_dest = self.__get_checksum(dest_file)
+
+            if cksum_temp != cksum_dest:
+                raise ChecksumError(
+                    'Temporary file and destination file checksum mismatch: Source=0x{}, Destination=0x{}'
+                    .format(cksum_temp, cksum_dest)
+                )
+
+            return
 
     # def __getattr__(self, name):
     #     """